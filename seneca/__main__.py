@@ -19,6 +19,14 @@ import sys
 
 
 def main(extensiondir):
+    if len(sys.argv) > 1 and sys.argv[1] == 'optimize':
+        from .repack import main as repack_main
+        sys.exit(repack_main(sys.argv[2:]))
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'export-text':
+        from .export import main as export_main
+        sys.exit(export_main(sys.argv[2:]))
+
     import logging
     logging.basicConfig(level=logging.INFO)
     logging.info('Started')
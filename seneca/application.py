@@ -74,6 +74,7 @@ class Application(Gtk.Application):
         windows = self.get_windows()
         for window in windows:
             window.settings.save()
+            window.book.doc.save_caches()
             window.destroy()
         Gtk.Application.do_shutdown(self)
 
@@ -110,6 +111,7 @@ class Application(Gtk.Application):
         """
         if len(self.get_windows()) > 1:
             window.settings.save()
+            window.book.doc.save_caches()
             window.destroy()
         else:
             self.quit()
@@ -15,7 +15,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import logging
+import os
+import re
+import threading
+import zipfile
 import gi
 
 gi.require_version('Gdk', '3.0')
@@ -24,17 +29,26 @@ gi.require_version('WebKit2', '4.0')
 from gi.repository import Gdk, Gio, GLib, GObject, Soup, WebKit2
 from gettext import gettext as _
 
-from .epub import Epub
+from .epub import ARCHIVE_ERRORS, Epub
+from .resource_cache import ResourceCache
+from .uri import decode_uri, get_epub_uri, split_uri
 from .book_error import BookError
 from .dbus_helper import DBusHelper
 from .javascript import BODY_JS, WRAPPER_JS, COL_JS, COL_JS_REMOVE
 
 logger = logging.getLogger(__name__)
 
+# Milliseconds to wait for a book file to stop changing before reloading it
+RELOAD_DELAY = 500
+# Bytes of audio or video inflated at a time when streaming them
+STREAM_CHUNK_SIZE = 64 * 1024
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
 
 class Book(WebKit2.WebView):
     __gsignals__ = {
         'scroll-percent-changed': (GObject.SIGNAL_RUN_FIRST, None, (float,)),
+        'note-activated': (GObject.SIGNAL_RUN_FIRST, None, (str,)),
     }
 
     def __init__(self, settings):
@@ -84,8 +98,14 @@ class Book(WebKit2.WebView):
         # DBUS PCI
         self.dbus_helper = DBusHelper()
 
+        # Decompressed resources of every open book share one budget
+        resource_cache = ResourceCache.get_default()
+        resource_cache.set_budget(self.settings.cachesize * 1024 * 1024)
+
         # Variables
         self.doc = Epub()
+        # Trade memory for not touching the disk again after opening
+        self.doc.keep_compressed = self.settings.keepcompressed
         self.identifier = ''
 
         self.__matches_list = []
@@ -105,6 +125,13 @@ class Book(WebKit2.WebView):
         self.on_text_found_id = 0
         self.on_text_not_found_id = 0
 
+        # File monitoring
+        self.doc_monitors = []
+        self.reload_timeout_id = 0
+
+        self.prefetch_source_id = 0
+        self.prefetch_queue = []
+
     def get_doc(self):
         return self.doc
 
@@ -114,13 +141,14 @@ class Book(WebKit2.WebView):
         Calls prepare_book() when done.
 
         Parameters:
-            gfile (Gio.File)
+            gfile (Gio.File): An epub file or an unpacked epub directory
 
         Raises:
             BookError
         """
         if self.on_reload_chapter_id:
             self.doc.disconnect(self.on_reload_chapter_id)
+            self.on_reload_chapter_id = 0
 
         try:
             path = gfile.get_path()
@@ -133,6 +161,54 @@ class Book(WebKit2.WebView):
         else:
             self._prepare_book()
 
+    def set_doc_async(self, gfile, cancellable, callback, *user_data):
+        """Create an Epub object using the path obtained from gfile, without
+        blocking the main loop
+
+        The current book stays usable until the new one is ready. Progress
+        is reported by the 'open-progress' signal of the Epub object. The
+        chapter to resume from is shown once the spine is known, the rest
+        of the index is completed in the background.
+        callback is called as callback(book, result, *user_data) and must
+        call set_doc_finish(result).
+
+        Parameters:
+            gfile (Gio.File): An epub file or an unpacked epub directory
+            cancellable (Gio.Cancellable)
+            callback (function)
+
+        Raises:
+            BookError
+        """
+        path = gfile.get_path()
+        if not path:
+            raise BookError(0, _('Empty path!'), '')
+
+        def on_doc_opened(epub, result):
+            callback(self, result, *user_data)
+
+        self.doc.open_async(path, cancellable, on_doc_opened)
+
+    def set_doc_finish(self, result):
+        """Finish set_doc_async()
+
+        Calls prepare_book() when the book was opened.
+
+        Parameters:
+            result (dict)
+
+        Raises:
+            BookError
+            GLib.Error: When the operation was cancelled
+        """
+        self.doc.open_finish(result)
+
+        if self.on_reload_chapter_id:
+            self.doc.disconnect(self.on_reload_chapter_id)
+            self.on_reload_chapter_id = 0
+
+        self._prepare_book()
+
     def get_title(self):
         if self.doc.path:
             return self.doc.title
@@ -237,6 +313,31 @@ class Book(WebKit2.WebView):
             self.emit('scroll-percent-changed',
                       self.get_book_position(position))
 
+    def set_page_label(self, label):
+        """Go to the start of a printed page
+
+        Args:
+            label (str): The page label, like '347' or 'xiv'
+
+        Returns:
+            True if the book has a page list with the page, or with a
+            numbered page before it
+        """
+        if not self.doc.path:
+            return False
+
+        target = self.doc.find_page_label(label)
+        if target is None:
+            return False
+
+        path, fragment = target
+        if path == self.doc.get_current_path() and fragment:
+            self._set_scroll_to_fragment(fragment)
+        else:
+            self.set_chapter_path_fragment(path, fragment)
+
+        return True
+
     def get_chapter(self):
         """Returns an int as chapter"""
         if self.doc.path:
@@ -384,7 +485,7 @@ class Book(WebKit2.WebView):
     # Internal functions #
 
     def _get_path_fragment(self, uri):
-        """Use Soup.URI to split uri
+        """Split uri the way Soup.URI does
 
         Args:
             uri (str)
@@ -396,9 +497,7 @@ class Book(WebKit2.WebView):
         fragment = None
 
         if uri:
-            soup_uri = Soup.URI.new(uri)
-            path = soup_uri.get_path()[1:]
-            fragment = soup_uri.get_fragment()
+            path, fragment = split_uri(uri)
 
         return [path, fragment]
 
@@ -423,18 +522,168 @@ class Book(WebKit2.WebView):
             request.finish_error(GLib.Error(error_str))
             return
 
+        path = decode_uri(path)
+
         if self.doc.is_page(path):
-            self.set_chapter_path_fragment(path, fragment)
+            if not self.settings.loadbyuri:
+                self.set_chapter_path_fragment(path, fragment)
+                return
+
+            # Chapters are served as they are, links to other chapters are
+            # followed by _follow_link(). Other documents, like the ones of
+            # the auxiliary spine or inside iframes, are served as well.
+            if (path in self.doc.spine_primary
+                    and path != self.doc.get_current_path()):
+                request.finish_error(GLib.Error('Not the current chapter'))
+                return
+
+        mime = self.doc.get_resource_mime(path)
+        if mime.startswith(('audio/', 'video/')):
+            self._finish_media_request(request, path, mime)
             return
 
-        resource_content = self.doc.get_resource_content(path)
-        resource_gbytes = GLib.Bytes(resource_content)
+        resource_gbytes = self.doc.get_resource_bytes(path)
         stream = Gio.MemoryInputStream.new_from_bytes(resource_gbytes)
         stream_length = resource_gbytes.get_size()
-        mime = self.doc.get_resource_mime(path)
 
         request.finish(stream, stream_length, mime)
 
+    def _finish_media_request(self, request, path, mime):
+        """Answer an epub scheme request for audio or video with a stream
+
+        The resource is inflated in pieces by a worker thread writing to a
+        pipe, so playback starts right away and memory use stays flat.
+        Range requests are answered with partial content when WebKit
+        supports custom responses.
+
+        Args:
+            request (WebKit2.URISchemeRequest)
+            path (str): The path of the resource
+            mime (str): The mime type of the resource
+        """
+        size = self.doc.get_resource_size(path)
+        start, end = 0, size - 1
+
+        # Partial responses need WebKitGTK 2.36
+        byte_range = None
+        if hasattr(WebKit2, 'URISchemeResponse'):
+            headers = request.get_http_headers()
+            if headers is not None:
+                byte_range = self._get_byte_range(headers.get_one('Range'),
+                                                  size)
+        if byte_range == ():
+            self._finish_unsatisfiable_range(request, size)
+            return
+        elif byte_range is not None:
+            start, end = byte_range
+
+        length = max(end - start + 1, 0)
+        resource_file = self.doc.open_resource(path)
+        read_fd, write_fd = os.pipe()
+
+        thread = threading.Thread(target=self._write_media_stream,
+                                  args=(resource_file, start, length,
+                                        write_fd),
+                                  daemon=True)
+        thread.start()
+
+        stream = Gio.UnixInputStream.new(read_fd, True)
+
+        if byte_range is None:
+            request.finish(stream, length, mime)
+            return
+
+        response_headers = Soup.MessageHeaders.new(
+            Soup.MessageHeadersType.RESPONSE)
+        response_headers.append('Accept-Ranges', 'bytes')
+        response_headers.append('Content-Range',
+                                'bytes {0}-{1}/{2}'.format(start, end, size))
+
+        response = WebKit2.URISchemeResponse.new(stream, length)
+        response.set_status(206, None)
+        response.set_content_type(mime)
+        response.set_http_headers(response_headers)
+        request.finish_with_response(response)
+
+    def _finish_unsatisfiable_range(self, request, size):
+        """Answer a range request that starts past the end of a resource
+
+        Args:
+            request (WebKit2.URISchemeRequest)
+            size (int): The size of the resource
+        """
+        response_headers = Soup.MessageHeaders.new(
+            Soup.MessageHeadersType.RESPONSE)
+        response_headers.append('Accept-Ranges', 'bytes')
+        response_headers.append('Content-Range', 'bytes */{0}'.format(size))
+
+        response = WebKit2.URISchemeResponse.new(Gio.MemoryInputStream.new(),
+                                                 0)
+        response.set_status(416, None)
+        response.set_http_headers(response_headers)
+        request.finish_with_response(response)
+
+    def _get_byte_range(self, range_header, size):
+        """Parse the Range header of a request
+
+        Args:
+            range_header (str): The value of the header, or None
+            size (int): The size of the resource
+
+        Returns:
+            A tuple with the first and last byte positions, an empty tuple
+            when the range has no byte of the resource, or None when the
+            whole resource is requested
+        """
+        match = BYTE_RANGE.match(range_header or '')
+        if not match:
+            return None
+
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            if last and int(last) < start:
+                # An invalid range, the header is ignored
+                return None
+            if start >= size:
+                return ()
+            end = min(int(last), size - 1) if last else size - 1
+        elif last:
+            # A suffix range, the last bytes of the resource
+            if not int(last) or not size:
+                return ()
+            start = max(size - int(last), 0)
+            end = size - 1
+        else:
+            return None
+
+        return start, end
+
+    def _write_media_stream(self, resource_file, start, length, write_fd):
+        """Copy a range of a resource to a pipe, a piece at a time
+
+        Runs in a worker thread. It stops early when the reading end of the
+        pipe is closed, like when the view stops playing.
+
+        Args:
+            resource_file: A binary file object returned by open_resource()
+            start (int): The position of the first byte to copy
+            length (int): The number of bytes to copy
+            write_fd (int): The writing end of the pipe
+        """
+        try:
+            with resource_file, os.fdopen(write_fd, 'wb') as pipe:
+                resource_file.seek(start)
+                while length > 0:
+                    chunk = resource_file.read(min(length, STREAM_CHUNK_SIZE))
+                    if not chunk:
+                        break
+
+                    pipe.write(chunk)
+                    length -= len(chunk)
+        except (OSError, zipfile.BadZipFile) as e:
+            logger.info('Media stream stopped:' + str(e))
+
     def _on_decide_policy(self, web_view, decision, decision_type):
         """Decide what to do when clicked on link
 
@@ -447,14 +696,90 @@ class Book(WebKit2.WebView):
             True to stop other handlers from being invoked for the event.
             False to propagate the event further.
         """
+        if decision_type is WebKit2.PolicyDecisionType.NAVIGATION_ACTION:
+            action = decision.get_navigation_action()
+            if (action.get_navigation_type()
+                    is WebKit2.NavigationType.LINK_CLICKED):
+                uri = action.get_request().get_uri()
+                if self._activate_note(decision, uri):
+                    return True
+
+                if self.settings.loadbyuri:
+                    return self._follow_link(decision, uri)
+
+                return False
+
         if decision_type is WebKit2.PolicyDecisionType.RESPONSE:
             response = WebKit2.ResponsePolicyDecision.get_response(decision)
             uri = response.get_uri()
+            if uri.startswith('epub:'):
+                # Documents of the book loaded by their URI
+                decision.use()
+                return True
+
             ctx = Gio.AppLaunchContext.new()
             Gio.AppInfo.launch_default_for_uri(uri, ctx)
             decision.ignore()
             return True
 
+    def _follow_link(self, decision, uri):
+        """Follow a link to a chapter of the book by changing the current
+        chapter, so the page of the Epub object and the saved position are
+        kept up to date
+
+        Args:
+            decision (WebKit2.NavigationPolicyDecision)
+            uri (str): The URI of the link
+
+        Returns:
+            True if the link points to a chapter of the book
+        """
+        if not uri.startswith('epub:'):
+            return False
+
+        path, fragment = self._get_path_fragment(uri)
+        path = decode_uri(path)
+        if not self.doc.is_page(path):
+            return False
+
+        decision.ignore()
+
+        if path == self.doc.get_current_path() and fragment:
+            self._set_scroll_to_fragment(fragment)
+        else:
+            self.set_chapter_path_fragment(path, fragment)
+
+        return True
+
+    def _activate_note(self, decision, uri):
+        """Show a note instead of following a link to it
+
+        Args:
+            decision (WebKit2.NavigationPolicyDecision)
+            uri (str): The URI of the link
+
+        Returns:
+            True if the link points to a note
+        """
+        if not uri.startswith('epub:'):
+            return False
+
+        path, fragment = self._get_path_fragment(uri)
+
+        try:
+            note = self.doc.get_note(decode_uri(path), fragment)
+        except BookError as e:
+            logger.info('Could not read note:' + str(e.args[1]))
+            return False
+
+        if note is None:
+            return False
+
+        decision.ignore()
+        self.emit('note-activated', note)
+
+        return True
+
     def _prepare_book(self):
         """Set relevant variables for the book
 
@@ -472,31 +797,161 @@ class Book(WebKit2.WebView):
         chapter = self.settings.get_chapter(self.identifier)
         self.set_chapter(chapter)
         self._reload_chapter()
+        # Read the stylesheets and images of the chapter while the view
+        # parses it
+        self._queue_prefetch()
 
         if not self.on_reload_chapter_id:
             self.on_reload_chapter_id = self.doc.connect('notify::page',
                                                          self._reload_chapter)
 
+        self._watch_doc()
+
+        if not self.on_load_set_pos_id:
+            position = self.settings.get_position(self.identifier)
+            self.on_load_set_pos_id = self.connect('load-changed',
+                                                   self._on_load_set_pos,
+                                                   position)
+
+    def _watch_doc(self):
+        """Monitor the book file, or every directory of an unpacked book,
+        to reload it when it changes on disk"""
+        self._unwatch_doc()
+
+        if os.path.isdir(self.doc.path):
+            paths = [dirpath for dirpath, dirnames, filenames
+                     in os.walk(self.doc.path)]
+        else:
+            paths = [self.doc.path]
+
+        for path in paths:
+            gfile = Gio.File.new_for_path(path)
+            try:
+                monitor = gfile.monitor(Gio.FileMonitorFlags.NONE, None)
+            except GLib.Error as e:
+                logger.warning('Could not monitor book:' + str(e))
+                continue
+
+            monitor.connect('changed', self._on_doc_file_changed)
+            self.doc_monitors.append(monitor)
+
+    def _unwatch_doc(self):
+        """Stop monitoring the book and forget any pending reload"""
+        for monitor in self.doc_monitors:
+            monitor.cancel()
+        self.doc_monitors = []
+
+        if self.reload_timeout_id:
+            GLib.source_remove(self.reload_timeout_id)
+            self.reload_timeout_id = 0
+
+    def _on_doc_file_changed(self, monitor, gfile, other_gfile, event_type):
+        """Schedule a reload of the book once it stops changing
+
+        Args:
+            monitor (Gio.FileMonitor)
+            gfile (Gio.File)
+            other_gfile (Gio.File)
+            event_type (Gio.FileMonitorEvent)
+        """
+        if event_type in (Gio.FileMonitorEvent.ATTRIBUTE_CHANGED,
+                          Gio.FileMonitorEvent.PRE_UNMOUNT,
+                          Gio.FileMonitorEvent.UNMOUNTED):
+            return
+
+        # The file may be truncated while it is rewritten
+        self.doc.release_mapping()
+
+        if self.reload_timeout_id:
+            GLib.source_remove(self.reload_timeout_id)
+
+        self.reload_timeout_id = GLib.timeout_add(RELOAD_DELAY,
+                                                  self._on_reload_timeout)
+
+    def _on_reload_timeout(self):
+        """Reload the parts of the book that changed on disk, and the
+        current chapter if it is affected, keeping the reading position
+
+        Returns:
+            False to remove the timeout source
+        """
+        self.reload_timeout_id = 0
+        chapter_path = self.doc.get_current_path()
+
+        try:
+            dependencies = self.doc.get_dependencies(chapter_path)
+        except (BookError,) + ARCHIVE_ERRORS:
+            dependencies = None
+
+        try:
+            changed = self.doc.reload()
+        except BookError as e:
+            # Probably still being written, wait for the next change
+            logger.warning('Could not reload book:' + str(e.args[1]))
+            return False
+
+        if not self._is_chapter_affected(chapter_path, dependencies, changed):
+            return False
+
         if not self.on_load_set_pos_id:
             position = self.settings.get_position(self.identifier)
             self.on_load_set_pos_id = self.connect('load-changed',
                                                    self._on_load_set_pos,
                                                    position)
+        self._reload_chapter()
+
+        return False
+
+    def _is_chapter_affected(self, chapter_path, dependencies, changed):
+        """Check if a chapter has to be loaded again after a reload
+
+        Args:
+            chapter_path (str): The chapter shown before the reload
+            dependencies (tuple): The resources the chapter used before the
+                reload, or None when unknown
+            changed (set): The paths of the members that changed
+
+        Returns:
+            True when the chapter, or something it uses, changed
+        """
+        if chapter_path != self.doc.get_current_path():
+            return True
+
+        if chapter_path in changed or self.doc.opf_path in changed:
+            return True
+
+        if dependencies is not None:
+            return not changed.isdisjoint(dependencies)
+
+        # Without dependencies, any stylesheet, image or font may be used
+        for path in changed:
+            if path in self.doc.resources and not self.doc.is_page(path):
+                return True
+
+        return False
 
     def _reload_chapter(self, epub=None, paramspec=None):
         """Use Epub's page number to retrieve the resource and load it into view.
 
+        When loading by URI, the chapter is served unchanged by the epub
+        scheme and WebKit resolves its links against its URI. Otherwise its
+        links are rewritten to the epub scheme and it is loaded as bytes.
+
         Args:
             epub (GObject.Object)
             paramspec (GObject.ParamSpec)
         """
-        resource_content = self.doc.get_current_with_epub_uris()
-        resource_gbytes = GLib.Bytes(resource_content)
-        mime = self.doc.get_current_mime()
-        encoding = 'UTF-8'
-        base_uri = None
+        if self.settings.loadbyuri:
+            self.load_uri(get_epub_uri(self.doc.get_current_path()))
+        else:
+            resource_content = self.doc.get_current_with_epub_uris()
+            resource_gbytes = GLib.Bytes(resource_content)
+            mime = self.doc.get_current_mime()
+            encoding = 'UTF-8'
+            base_uri = None
+
+            self.load_bytes(resource_gbytes, mime, encoding, base_uri)
 
-        self.load_bytes(resource_gbytes, mime, encoding, base_uri)
         self.__page_turning = True
 
     def _on_load_change(self, webview, load_event):
@@ -514,6 +969,61 @@ class Book(WebKit2.WebView):
                 self.on_resize_id = self.connect('size-allocate',
                                                  self._on_resize)
 
+            self._queue_prefetch()
+
+    def _queue_prefetch(self):
+        """Read ahead, one step per idle iteration: the resources the
+        current chapter depends on, the notes of the documents it links to,
+        and then the next chapter and the resources it depends on"""
+        chapter = self.get_chapter()
+        if chapter is None:
+            return
+
+        current_path = self.doc.get_current_path()
+        self.prefetch_queue = [
+            functools.partial(self.doc.prefetch, current_path, False),
+            functools.partial(self._prefetch_notes, current_path)]
+        if chapter + 1 < self.doc.get_n_pages():
+            self.prefetch_queue.append(
+                functools.partial(self.doc.prefetch,
+                                  self.doc.spine_primary[chapter + 1],
+                                  not self.settings.loadbyuri))
+
+        if not self.prefetch_source_id:
+            self.prefetch_source_id = GLib.idle_add(
+                self._on_prefetch_idle,
+                priority=GLib.PRIORITY_LOW)
+
+    def _prefetch_notes(self, path):
+        for linked_path in self.doc.get_links(path):
+            self.doc.get_notes(linked_path)
+
+    def _on_prefetch_idle(self):
+        """Run the next step queued by _queue_prefetch()
+
+        Returns:
+            True while there are steps left
+        """
+        # Cleared first, so prefetching can be queued again whatever
+        # happens in this step
+        source_id = self.prefetch_source_id
+        self.prefetch_source_id = 0
+
+        try:
+            if self.prefetch_queue:
+                self.prefetch_queue.pop(0)()
+        except BookError as e:
+            logger.info('Could not prefetch chapter:' + str(e.args[1]))
+        except ARCHIVE_ERRORS + (KeyError,) as e:
+            # Like while the book is replaced, before it is reloaded
+            logger.info('Could not prefetch chapter:' + str(e))
+
+        if not self.prefetch_queue:
+            return False
+
+        self.prefetch_source_id = source_id
+        return True
+
     def _setup_view(self):
         """Run javascript with styles"""
         gdk_color = Gdk.Color.parse(self.settings.color_bg)
@@ -0,0 +1,253 @@
+# cache.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import logging
+import os
+
+from gi.repository import GLib
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache_dir(name: str) -> str:
+    """
+    Get a directory inside the user cache directory of seneca
+
+    :param name: The name of the directory
+    :return: The path to the directory, which may not exist yet
+    """
+    usercachedir = GLib.get_user_cache_dir()
+    prgname = 'seneca'
+
+    return os.path.join(usercachedir, prgname, name)
+
+
+def get_path_hash(path: str) -> str:
+    """
+    Hash a path to use it as a file name
+
+    :param path: A path to a file
+    :return: A hexadecimal digest
+    """
+    path = os.path.abspath(path)
+
+    return hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def get_book_identity(path: str, content_hash: str) -> str:
+    """
+    Identify a version of a book file
+
+    The identity changes whenever the file is moved or modified.
+
+    :param path: The path to the book file
+    :param content_hash: A hash of the content of the book
+    :return: A hexadecimal digest
+    """
+    stat = os.stat(path)
+    identity = '{0}\n{1}\n{2}\n{3}'.format(os.path.abspath(path),
+                                           stat.st_size,
+                                           stat.st_mtime_ns,
+                                           content_hash)
+
+    return hashlib.sha1(
+        identity.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+class IndexCache:
+    # Increase when the layout of the stored index changes
+    VERSION = 8
+
+    def __init__(self, name: str = 'index'):
+        """
+        Initialize IndexCache class
+
+        :param name: The name of the directory of this cache
+        """
+        self.path = get_cache_dir(name)
+
+    def load(self, path: str, identity: str):
+        """
+        Load the stored index of a book
+
+        :param path: The path to the book file
+        :param identity: The identity of the book, see get_book_identity
+        :return: The stored index or None when there is no valid entry for
+            this version of the book
+        """
+        cache_path = self._get_cache_path(path)
+
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+        if (entry.get('version') != self.VERSION
+                or entry.get('identity') != identity):
+            return None
+
+        return entry.get('index')
+
+    def save(self, path: str, identity: str, index) -> None:
+        """
+        Store the index of a book, replacing any older entry for its path
+
+        :param path: The path to the book file
+        :param identity: The identity of the book, see get_book_identity
+        :param index: An object that can be serialized to JSON
+        """
+        cache_path = self._get_cache_path(path)
+        entry = {'version': self.VERSION,
+                 'identity': identity,
+                 'index': index}
+
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+                json.dump(entry, cache_file)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning('Could not save index cache:' + str(e))
+
+    def _get_cache_path(self, path):
+        return os.path.join(self.path, get_path_hash(path) + '.json')
+
+
+class ChapterCache:
+    # Increase when the way documents are rewritten changes
+    VERSION = 2
+
+    def __init__(self, budget: int = 128 * 1024 * 1024):
+        """
+        Initialize ChapterCache class
+
+        :param budget: The maximum number of bytes to keep on disk
+        """
+        self.path = get_cache_dir('chapters')
+        self.budget = budget
+        self._size = None
+
+    def load(self, identity: str, path: str):
+        """
+        Load a stored document
+
+        :param identity: The identity of the book, see get_book_identity
+        :param path: The path of the document inside the book
+        :return: The content of the document or None
+        """
+        cache_path = self._get_cache_path(identity, path)
+
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                content = cache_file.read()
+            # The modification time tells which documents were used last
+            os.utime(cache_path)
+        except OSError:
+            return None
+
+        return content
+
+    def save(self, identity: str, path: str, content: bytes) -> None:
+        """
+        Store a document, removing the least recently used ones when the
+        cache grows over its budget
+
+        :param identity: The identity of the book, see get_book_identity
+        :param path: The path of the document inside the book
+        :param content: The content of the document
+        """
+        if len(content) > self.budget:
+            return
+
+        cache_path = self._get_cache_path(identity, path)
+
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+
+            if self._size is None:
+                self._size = self._get_size()
+
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'wb') as cache_file:
+                cache_file.write(content)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning('Could not save chapter cache:' + str(e))
+            return
+
+        self._size += len(content)
+        if self._size > self.budget:
+            self._trim()
+
+    def _get_cache_path(self, identity, path):
+        key = '{0}\n{1}\n{2}'.format(self.VERSION, identity, path)
+        key_hash = hashlib.sha1(key.encode('utf-8', 'surrogateescape'))
+
+        return os.path.join(self.path, key_hash.hexdigest())
+
+    def _get_entries(self):
+        """
+        List the stored documents
+
+        :return: A list of (modification time, size, path) tuples
+        """
+        entries = []
+
+        try:
+            with os.scandir(self.path) as dir_entries:
+                for entry in dir_entries:
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime_ns,
+                                        stat.st_size,
+                                        entry.path))
+        except OSError:
+            pass
+
+        return entries
+
+    def _get_size(self):
+        return sum(entry[1] for entry in self._get_entries())
+
+    def _trim(self):
+        """
+        Remove the least recently used documents until the cache uses
+        three quarters of its budget
+        """
+        entries = sorted(self._get_entries())
+        size = sum(entry[1] for entry in entries)
+        target = self.budget * 3 // 4
+
+        for mtime, entry_size, entry_path in entries:
+            if size <= target:
+                break
+
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+
+            size -= entry_size
+
+        self._size = size
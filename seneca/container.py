@@ -0,0 +1,507 @@
+# container.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import hashlib
+import io
+import os
+import posixpath
+import struct
+import zipfile
+import zlib
+
+from gi.repository import GLib
+
+# Local file header: signature, versions, flags, compression, times, crc,
+# sizes, file name length and extra field length.
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+# Threads inflating members at the same time in bulk reads, zlib releases
+# the GIL while inflating
+BULK_READ_WORKERS = os.cpu_count() or 1
+
+
+class ZipContainer:
+
+    def __init__(self, path: str, resident: bool = False) -> None:
+        """
+        Open a zip archive for reading
+
+        The central directory is read once, members are read on demand.
+        Stored (uncompressed) members can be served as slices of a memory
+        mapping of the archive, without copying them. Every read goes
+        through the file opened here, so the offsets of the central
+        directory keep matching the data even if the path is replaced.
+
+        A resident archive is read whole into memory once, members are kept
+        in their compressed form and inflated each time they are read.
+
+        :param path: The path to the zip file
+        :param resident: Whether to keep the archive in memory
+        :raises zipfile.BadZipFile: When the file is not a zip archive
+        :raises OSError: When a resident archive can not be read
+        """
+        self.path = path
+        self._raw = None
+
+        if resident:
+            with open(path, 'rb') as zip_file:
+                self._raw = zip_file.read()
+
+        zip_source = io.BytesIO(self._raw) if resident else path
+        self._zip = zipfile.ZipFile(zip_source,
+                                    'r',
+                                    compression=zipfile.ZIP_DEFLATED,
+                                    allowZip64=True)
+        self._fd = -1
+        self._mapped_file = None
+        self._mapped_bytes = None
+        self._data_offsets = {}
+
+        if not resident:
+            # A descriptor of the file the central directory was read from,
+            # for reading members with os.pread() from several threads
+            self._fd = os.dup(self._zip.fp.fileno())
+            try:
+                self._mapped_file = GLib.MappedFile.new_from_fd(self._fd,
+                                                                False)
+                self._mapped_bytes = self._mapped_file.get_bytes()
+            except GLib.Error:
+                self._mapped_file = None
+
+    def namelist(self) -> list:
+        return self._zip.namelist()
+
+    def getinfo(self, name: str) -> zipfile.ZipInfo:
+        """
+        Get the information of a member without reading it
+
+        :param name: The path of the member inside the archive
+        :return: A zipfile.ZipInfo object
+        :raises KeyError: When the member does not exist
+        """
+        return self._zip.getinfo(name)
+
+    def read(self, name: str) -> bytes:
+        """
+        Read and inflate a member
+
+        :param name: The path of the member inside the archive
+        :return: The content of the member
+        :raises KeyError: When the member does not exist
+        """
+        return self._zip.read(name)
+
+    def read_many(self, names) -> dict:
+        """
+        Read and inflate several members at once
+
+        The members are split in batches of about the same compressed size,
+        each batch is inflated by its own thread with its own file handle.
+
+        :param names: An iterable with the paths of the members
+        :return: A dictionary with the content of the members by path
+        :raises KeyError: When a member does not exist
+        :raises zipfile.BadZipFile: When a member is corrupt
+        """
+        infos = [self._zip.getinfo(name) for name in names]
+        n_workers = min(BULK_READ_WORKERS, len(infos))
+
+        if n_workers <= 1:
+            return {info.filename: self.read(info.filename)
+                    for info in infos}
+
+        # Give the biggest members first to the least loaded batch
+        batches = [[] for i in range(n_workers)]
+        batch_sizes = [0] * n_workers
+        for info in sorted(infos, key=lambda info: -info.compress_size):
+            i = batch_sizes.index(min(batch_sizes))
+            batches[i].append(info)
+            batch_sizes[i] += info.compress_size
+
+        contents = {}
+        with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+            for batch_contents in executor.map(self._read_batch, batches):
+                contents.update(batch_contents)
+
+        return contents
+
+    def open(self, name: str):
+        """
+        Open a member for reading it in pieces
+
+        Compressed members are inflated as they are read. Seeking forward
+        inflates and skips the data in between, seeking backwards starts
+        inflating from the beginning again.
+
+        :param name: The path of the member inside the archive
+        :return: A seekable binary file object
+        :raises KeyError: When the member does not exist
+        """
+        return self._zip.open(name)
+
+    def is_stored(self, name: str) -> bool:
+        """
+        Check if a member can be used as it is in the archive
+
+        :param name: The path of the member inside the archive
+        :return: True when the member is neither compressed nor encrypted
+        """
+        info = self._zip.getinfo(name)
+
+        return (info.compress_type == zipfile.ZIP_STORED
+                and not info.flag_bits & 0x1)
+
+    def get_bytes(self, name: str) -> GLib.Bytes:
+        """
+        Get the content of a member as a GLib.Bytes
+
+        Stored members are slices of the mapped archive, so no copy of
+        their content is made. Compressed members are inflated.
+
+        :param name: The path of the member inside the archive
+        :return: A GLib.Bytes object
+        :raises KeyError: When the member does not exist
+        """
+        if not self.is_stored(name):
+            return GLib.Bytes(self.read(name))
+
+        info = self._zip.getinfo(name)
+        if not info.file_size:
+            return GLib.Bytes(b'')
+
+        if self._raw is not None:
+            offset = self._get_data_offset(info)
+            return GLib.Bytes(self._raw[offset:offset + info.file_size])
+
+        mapped_bytes = self._mapped_bytes
+        if mapped_bytes is None:
+            return GLib.Bytes(self.read(name))
+
+        offset = self._get_data_offset(info)
+
+        return GLib.Bytes.new_from_bytes(mapped_bytes, offset, info.file_size)
+
+    def get_directory_hash(self) -> str:
+        """
+        Hash the central directory of the archive
+
+        Every member is represented by its name, CRC and sizes, so the hash
+        changes whenever the content of the archive does.
+
+        :return: A hexadecimal digest
+        """
+        directory_hash = hashlib.sha1()
+
+        for info in self._zip.infolist():
+            entry = '{0}\0{1:08x}\0{2}\0{3}\n'.format(info.filename,
+                                                     info.CRC,
+                                                     info.compress_size,
+                                                     info.file_size)
+            directory_hash.update(entry.encode('utf-8', 'surrogateescape'))
+
+        return directory_hash.hexdigest()
+
+    def get_member_signatures(self) -> dict:
+        """
+        Get a value for every member that changes when the member does
+
+        :return: A dictionary of (CRC, size) tuples by member path
+        """
+        return {info.filename: (info.CRC, info.file_size)
+                for info in self._zip.infolist()}
+
+    def release_mapping(self) -> None:
+        """
+        Stop serving members from the memory mapping of the archive
+
+        Reading a mapping of a file that was truncated kills the process
+        with SIGBUS, so the mapping is dropped as soon as the file is known
+        to change. Members are read from the file from then on.
+        """
+        self._mapped_bytes = None
+        self._mapped_file = None
+
+    def close(self) -> None:
+        self._zip.close()
+        self._raw = None
+        self._mapped_bytes = None
+        self._mapped_file = None
+        self._data_offsets = {}
+
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _read_batch(self, infos):
+        """
+        Read and inflate members, in a worker thread
+
+        :param infos: A list of zipfile.ZipInfo objects
+        :return: A dictionary with the content of the members by path
+        """
+        contents = {}
+
+        for info in infos:
+            if (info.flag_bits & 0x1 or info.compress_type
+                    not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)):
+                contents[info.filename] = self.read(info.filename)
+                continue
+
+            offset = self._get_data_offset(info)
+            if self._raw is not None:
+                raw = memoryview(self._raw)[offset:
+                                            offset + info.compress_size]
+            else:
+                raw = self._pread(info.compress_size, offset, info.filename)
+
+            if info.compress_type == zipfile.ZIP_STORED:
+                content = bytes(raw)
+            else:
+                content = zlib.decompress(raw, -zlib.MAX_WBITS,
+                                          max(info.file_size, 1))
+
+            if zlib.crc32(content) != info.CRC:
+                raise zipfile.BadZipFile('Bad CRC-32 for file '
+                                         + info.filename)
+
+            contents[info.filename] = content
+
+        return contents
+
+    def _pread(self, size, offset, name):
+        """
+        Read a part of the archive without moving the position of the file
+
+        :param size: The number of bytes to read
+        :param offset: The position of the first byte
+        :param name: The member being read, for the error message
+        :return: The bytes read
+        :raises zipfile.BadZipFile: When the file is shorter than expected
+        """
+        data = os.pread(self._fd, size, offset)
+        if len(data) < size:
+            raise zipfile.BadZipFile('Truncated file: ' + name)
+
+        return data
+
+    def _get_data_offset(self, info):
+        """
+        Find where the data of a member starts inside the archive
+
+        The local header may carry a different extra field than the central
+        directory, so its lengths are read from the archive itself.
+
+        :param info: A zipfile.ZipInfo object
+        :return: The offset of the first byte of the member data
+        """
+        offset = self._data_offsets.get(info.filename)
+        if offset is not None:
+            return offset
+
+        mapped_bytes = self._mapped_bytes
+        if self._raw is not None:
+            header = LOCAL_HEADER.unpack_from(self._raw, info.header_offset)
+        elif mapped_bytes is not None:
+            header_bytes = GLib.Bytes.new_from_bytes(mapped_bytes,
+                                                     info.header_offset,
+                                                     LOCAL_HEADER.size)
+            header = LOCAL_HEADER.unpack(header_bytes.get_data())
+        else:
+            header = LOCAL_HEADER.unpack(self._pread(LOCAL_HEADER.size,
+                                                     info.header_offset,
+                                                     info.filename))
+
+        if header[0] != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile('Bad local header: ' + info.filename)
+
+        name_length, extra_length = header[-2:]
+        offset = (info.header_offset + LOCAL_HEADER.size
+                  + name_length + extra_length)
+        self._data_offsets[info.filename] = offset
+
+        return offset
+
+
+class DirectoryContainer:
+
+    def __init__(self, path: str) -> None:
+        """
+        Open an unpacked epub directory for reading
+
+        It offers the same interface as ZipContainer, members are read
+        straight from the filesystem.
+
+        :param path: The path to the directory
+        """
+        self.path = path
+        # Like the central directory of a zip file, the state of the
+        # members when the container is opened
+        self._signatures = self._stat_members()
+
+    def namelist(self) -> list:
+        names = []
+
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                name = os.path.relpath(file_path, self.path)
+                names.append(name.replace(os.sep, '/'))
+
+        return names
+
+    def getinfo(self, name: str) -> zipfile.ZipInfo:
+        """
+        Get the information of a member without reading it
+
+        :param name: The path of the member inside the directory
+        :return: A zipfile.ZipInfo object
+        :raises KeyError: When the member does not exist
+        """
+        try:
+            stat = os.stat(self._get_member_path(name))
+        except OSError:
+            raise KeyError(name) from None
+
+        info = zipfile.ZipInfo(name)
+        info.compress_type = zipfile.ZIP_STORED
+        info.file_size = stat.st_size
+        info.compress_size = stat.st_size
+
+        return info
+
+    def read(self, name: str) -> bytes:
+        """
+        Read a member
+
+        :param name: The path of the member inside the directory
+        :return: The content of the member
+        :raises KeyError: When the member does not exist
+        """
+        try:
+            with open(self._get_member_path(name), 'rb') as member:
+                return member.read()
+        except OSError:
+            raise KeyError(name) from None
+
+    def open(self, name: str):
+        """
+        Open a member for reading it in pieces
+
+        :param name: The path of the member inside the directory
+        :return: A seekable binary file object
+        :raises KeyError: When the member does not exist
+        """
+        try:
+            return open(self._get_member_path(name), 'rb')
+        except OSError:
+            raise KeyError(name) from None
+
+    def read_many(self, names) -> dict:
+        """
+        Read several members at once, on a pool of threads
+
+        :param names: An iterable with the paths of the members
+        :return: A dictionary with the content of the members by path
+        :raises KeyError: When a member does not exist
+        """
+        names = list(names)
+        n_workers = min(BULK_READ_WORKERS, len(names))
+
+        if n_workers <= 1:
+            return {name: self.read(name) for name in names}
+
+        with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+            return dict(zip(names, executor.map(self.read, names)))
+
+    def is_stored(self, name: str) -> bool:
+        return os.path.isfile(self._get_member_path(name))
+
+    def get_bytes(self, name: str) -> GLib.Bytes:
+        """
+        Get the content of a member as a GLib.Bytes
+
+        The file is read rather than mapped: unpacked books are edited in
+        place, and a mapping of a file truncated while the view still holds
+        it faults with SIGBUS.
+
+        :param name: The path of the member inside the directory
+        :return: A GLib.Bytes object
+        :raises KeyError: When the member does not exist
+        """
+        return GLib.Bytes(self.read(name))
+
+    def get_directory_hash(self) -> str:
+        """
+        Hash the names, sizes and modification times of every member
+
+        :return: A hexadecimal digest
+        """
+        directory_hash = hashlib.sha1()
+
+        for name in self.namelist():
+            stat = os.stat(self._get_member_path(name))
+            entry = '{0}\0{1}\0{2}\n'.format(name,
+                                             stat.st_size,
+                                             stat.st_mtime_ns)
+            directory_hash.update(entry.encode('utf-8', 'surrogateescape'))
+
+        return directory_hash.hexdigest()
+
+    def get_member_signatures(self) -> dict:
+        """
+        Get a value for every member that changes when the member does,
+        as they were when the container was opened
+
+        :return: A dictionary of (mtime, size) tuples by member path
+        """
+        return dict(self._signatures)
+
+    def release_mapping(self) -> None:
+        # Members are never mapped, see get_bytes()
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def _stat_members(self):
+        signatures = {}
+
+        for name in self.namelist():
+            try:
+                stat = os.stat(self._get_member_path(name))
+            except OSError:
+                continue
+            signatures[name] = (stat.st_mtime_ns, stat.st_size)
+
+        return signatures
+
+    def _get_member_path(self, name):
+        """
+        Get the filesystem path of a member, without leaving the directory
+
+        :param name: The path of the member inside the directory
+        :return: The path to the member file
+        :raises KeyError: When the name points outside the directory
+        """
+        member_path = posixpath.normpath(name)
+        if (member_path.startswith('../') or member_path == '..'
+                or posixpath.isabs(member_path)):
+            raise KeyError(name)
+
+        return os.path.join(self.path, *member_path.split('/'))
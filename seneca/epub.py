@@ -15,19 +15,37 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import html as python_html
+import io
+import logging
 import posixpath
+import re
 import sys
+import threading
+import urllib.parse
 import zipfile
-import gi
+import zlib
 
-gi.require_version('Soup', '2.4')
-from gi.repository import GLib, GObject, Soup
+from gi.repository import Gio, GLib, GObject
 from gettext import gettext as _
 from lxml import etree
 from lxml import html
 
 from .book_error import BookError
+from .cache import ChapterCache, IndexCache, get_book_identity
+from .container import DirectoryContainer, ZipContainer
+from .manifest import ManifestItem, MediaOverlay, PageList, Spine
+from .manifest import get_clock_seconds
+from .resource_cache import ResourceCache
+from .uri import decode_uri, resolve_href, resolve_href_path, split_uri
+
+logger = logging.getLogger(__name__)
+
+# Errors raised when reading an archive that is broken, or that changed
+# while it was being read
+ARCHIVE_ERRORS = (zipfile.BadZipFile, zipfile.LargeZipFile, zlib.error,
+                  EOFError, OSError)
 
 OASIS = '{urn:oasis:names:tc:opendocument:xmlns:container}'
 OPF = '{http://www.idpf.org/2007/opf}'
@@ -36,9 +54,79 @@ DAISY = '{http://www.daisy.org/z3986/2005/ncx/}'
 XHTML = '{http://www.w3.org/1999/xhtml}'
 EPUB = '{http://www.idpf.org/2007/ops}'
 XLINK = '{http://www.w3.org/1999/xlink}'
+SMIL = '{http://www.w3.org/ns/SMIL}'
+
+# Elements and attributes that make a document load another resource
+DEPENDENCY_ATTRIBUTES = (('link', 'href'),
+                         ('img', 'src'),
+                         ('image', XLINK + 'href'),
+                         ('image', 'href'),
+                         ('use', XLINK + 'href'),
+                         ('use', 'href'),
+                         ('content', 'src'),
+                         ('source', 'src'),
+                         ('audio', 'src'),
+                         ('video', 'src'),
+                         ('video', 'poster'),
+                         ('track', 'src'),
+                         ('script', 'src'),
+                         ('object', 'data'),
+                         ('embed', 'src'),
+                         ('iframe', 'src'))
+# Elements and attributes with a list of image candidates
+SRCSET_ATTRIBUTES = (('img', 'srcset'),
+                     ('source', 'srcset'))
+# Attributes pointed to the epub scheme, by local name of the element
+URI_ATTRIBUTES = {'link': 'href',
+                  'img': 'src',
+                  'image': XLINK + 'href',
+                  'a': 'href',
+                  'content': 'src'}
+# Elements and attributes that link a document to another one
+LINK_ATTRIBUTES = (('a', 'href'),
+                   ('a', XLINK + 'href'),
+                   ('area', 'href'))
+# Elements that end a line of text, and elements without readable text
+TEXT_BLOCK_TAGS = frozenset(('address', 'article', 'aside', 'blockquote',
+                             'br', 'caption', 'dd', 'div', 'dl', 'dt',
+                             'figcaption', 'figure', 'footer', 'h1', 'h2',
+                             'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li',
+                             'nav', 'ol', 'p', 'pre', 'section', 'table',
+                             'td', 'th', 'tr', 'ul'))
+TEXT_SKIPPED_TAGS = frozenset(('script', 'style'))
+WHITESPACE = re.compile(r'\s+')
+# Documents inflated at a time when extracting the text of a book
+TEXT_BATCH_SIZE = 8
+# Memory used to keep rewritten documents, see get_resource_with_epub_uris
+RENDERED_CACHE_BUDGET = 16 * 1024 * 1024
+# Seconds to wait before storing the dependencies and notes found while
+# reading, so the ones found in a row are written at once
+CACHE_SAVE_DELAY = 5
+# lxml parsers are reused between documents, but not between threads
+THREAD_PARSERS = threading.local()
+# Values of epub:type and role that mark a note, and ids commonly given to
+# notes by conversion tools, like 'fn12' or 'note_3'
+NOTE_TYPES = frozenset(('footnote', 'endnote', 'rearnote', 'note',
+                        'doc-footnote', 'doc-endnote'))
+NOTEREF_TYPES = frozenset(('noteref', 'doc-noteref'))
+NOTE_ID = re.compile(r'^(?:fn|ftn|footnote|note|en|endnote)[-_:.]?\d+$',
+                     re.IGNORECASE)
+CSS_URL = re.compile(r"""url\(\s*(['"]?)(.*?)\1\s*\)""")
+CSS_IMPORT = re.compile(r"""@import\s+(['"])(.*?)\1""")
+
+EpubMetadata = collections.namedtuple('EpubMetadata', ['path',
+                                                       'identifier',
+                                                       'title',
+                                                       'creator',
+                                                       'language',
+                                                       'cover_path',
+                                                       'cover'])
 
 
 class Epub(GObject.GObject):
+    __gsignals__ = {
+        'open-progress': (GObject.SIGNAL_RUN_FIRST, None, (float,)),
+    }
 
     def __init__(self) -> None:
         GObject.GObject.__init__(self)
@@ -55,96 +143,287 @@ class Epub(GObject.GObject):
         self.cover = ''
 
         self.direction = 'default'
-        self.spine_primary = []
-        self.spine_auxiliary = []
+        self.spine_primary = Spine()
+        self.spine_auxiliary = Spine()
         self.guide = []
         self.navigation = []
+        self.page_list = PageList()
         self.pages_positions = []
 
         self.toc_path = ''
+        self.opf_path = ''
         self.path = ''
-
+        self.book_identity = ''
+
+        # Set to None to always parse the OPF file
+        self.index_cache = IndexCache()
+        # Set to None to keep the dependencies in memory only
+        self.dependency_cache = IndexCache('dependencies')
+        self.chapter_cache = ChapterCache()
+        self.rendered_cache = ResourceCache(RENDERED_CACHE_BUDGET)
+        self.dependencies = {}
+        self.unsaved_dependencies = False
+        self.save_caches_source_id = 0
+        # Set to None to keep the notes in memory only
+        self.notes_cache = IndexCache('notes')
+        self.notes = {}
+        self.unsaved_notes = False
+        self.media_overlays = {}
+        self.resource_cache = ResourceCache.get_default()
+        # Keep the whole file in memory, with its members compressed
+        self.keep_compressed = False
+
+        self.__zip = None
         self.__current = 0
 
     def open(self, epub_path: str):
         """
-        Open an epub file from the path provided
+        Open an epub file, or an unpacked epub directory, from the path
+        provided
+
+        :param epub_path: The path to the epub file or directory
+        :raises BookError: When the file or format is incorrect.
+        """
+        epub_zip, index, nav = self._load(epub_path)
+        if nav is not None:
+            self._complete_index(epub_path, index, nav)
+
+        self._set_book(epub_path, epub_zip, index)
+
+    def open_async(self, epub_path: str,
+                   cancellable: Gio.Cancellable,
+                   callback: object,
+                   *user_data):
+        """
+        Open an epub file from the path provided without blocking
+
+        The container and OPF files are parsed in a worker thread while the
+        currently opened book stays usable. The 'open-progress' signal is
+        emitted on the main loop as parsing goes on. When done, callback is
+        called on the main loop as callback(epub, result, *user_data) and
+        it must call open_finish(result).
+
+        The book can be shown as soon as the spine is known. The page list,
+        the landmarks and the index cache entry are completed afterwards by
+        the same thread, and so is reading the file into memory when
+        keep_compressed is set.
 
         :param epub_path: The path to the epub file
+        :param cancellable: A Gio.Cancellable object or None
+        :param callback: The function to call when the operation is done
+        :param user_data: Extra arguments for callback
+        """
+        def report_progress(fraction):
+            GLib.idle_add(self.emit, 'open-progress', fraction)
+
+        def load():
+            result = {'path': epub_path,
+                      'cancellable': cancellable,
+                      'epub_zip': None,
+                      'index': None,
+                      'error': None}
+            try:
+                epub_zip, index, nav = self._load(epub_path, cancellable,
+                                                  report_progress,
+                                                  progressive=True)
+                result['epub_zip'], result['index'] = epub_zip, index
+            except (BookError, GLib.Error) as e:
+                result['error'] = e
+            except ARCHIVE_ERRORS as e:
+                result['error'] = BookError(0, _('Could not read zip format'),
+                                            epub_path)
+                result['error'].__cause__ = e
+            except Exception as e:
+                # Anything else would end the thread without calling back
+                logger.error('Could not open book:' + str(e))
+                result['error'] = BookError(0, _('Unrecognized file format'),
+                                            epub_path)
+                result['error'].__cause__ = e
+
+            GLib.idle_add(callback, self, result, *user_data)
+
+            if result['error'] is None:
+                self._complete_index_async(epub_path, cancellable,
+                                           dict(index), nav)
+
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+
+    def open_finish(self, result: dict):
+        """
+        Finish an operation started with open_async()
+
+        :param result: The result given to the callback of open_async()
         :raises BookError: When the file or format is incorrect.
+        :raises GLib.Error: When the operation was cancelled.
         """
-        if not GLib.file_test(epub_path, GLib.FileTest.EXISTS):
-            raise BookError(0, _('File does not exist'), epub_path)
+        if result['error'] is not None:
+            raise result['error']
 
-        if not GLib.file_test(epub_path, GLib.FileTest.IS_REGULAR):
-            raise BookError(0, _('Is a directory'), epub_path)
+        try:
+            self._check_cancelled(result['cancellable'])
+        except GLib.Error:
+            result['epub_zip'].close()
+            raise
 
-        epub_zip = self._open_zip_archive(epub_path)
+        self._set_book(result['path'], result['epub_zip'], result['index'])
 
-        if epub_zip is None:
-            raise BookError(0, _('Could not read zip format'), epub_path)
+    def read_metadata(self, epub_path: str,
+                      with_cover: bool = False) -> EpubMetadata:
+        """
+        Read the metadata of an epub file without opening it as a book
 
-        if not self._has_epub_mime(epub_zip):
-            raise BookError(0, _('Unrecognized file format'), epub_path)
+        Only the container and the OPF file are read, and the cover image
+        when requested. The currently opened book is not modified.
+
+        :param epub_path: The path to the epub file
+        :param with_cover: Whether to read the content of the cover image
+        :return: An EpubMetadata record
+        :raises BookError: When the file or format is incorrect.
+        """
+        epub_zip = self._open_epub_archive(epub_path)
 
         try:
-            opf_path = self._read_opf_path(epub_zip)
-            if opf_path is None:
-                raise BookError(0, '')
-        except BookError:
-            raise BookError(0, _('Broken or missing OPF file'), epub_path)
+            opf_path, opf_content = self._read_opf(epub_path, epub_zip)
+            opf = self._parse_opf(opf_path, opf_content, epub_zip)
+            metadata = opf['metadata']
+            cover_path = opf['cover']
+
+            cover = None
+            if with_cover and cover_path:
+                try:
+                    cover = self._read_inner_zip_path(epub_zip, cover_path)
+                except BookError:
+                    cover_path = ''
+        finally:
+            epub_zip.close()
+
+        return EpubMetadata(path=epub_path,
+                            identifier=metadata.get('identifier', [''])[0],
+                            title=metadata.get('title', [''])[0],
+                            creator=metadata.get('creator', [''])[0],
+                            language=metadata.get('language', [''])[0],
+                            cover_path=cover_path,
+                            cover=cover)
+
+    def read_identity(self, epub_path: str) -> str:
+        """
+        Identify the current version of an epub file without opening it as
+        a book. Only the zip central directory is read.
+
+        :param epub_path: The path to the epub file or directory
+        :return: A string that changes whenever the file changes
+        :raises BookError: When the file or format is incorrect.
+        """
+        epub_zip = self._open_epub_archive(epub_path)
 
         try:
-            opf_content = self._read_inner_zip_path(epub_zip, opf_path)
+            return self._get_book_identity(epub_path, epub_zip)
+        finally:
+            epub_zip.close()
+
+    def reload(self) -> set:
+        """
+        Read again the current book after it changed on disk
+
+        Only the members that changed are evicted from the resource cache,
+        and the OPF file is parsed again only when it or the container
+        changed. The current page is kept when its document still is in
+        the spine.
+
+        :return: A set with the paths of the members that changed
+        :raises BookError: When the file or format is incorrect.
+        """
+        try:
+            epub_zip = self._open_epub_archive(self.path,
+                                               self.keep_compressed)
+        except ARCHIVE_ERRORS as e:
+            raise BookError(0, _('Could not read zip format'),
+                            self.path) from e
+
+        try:
+            old_signatures = self.__zip.get_member_signatures()
+            new_signatures = epub_zip.get_member_signatures()
+            changed = {name for name in old_signatures.keys()
+                       | new_signatures.keys()
+                       if old_signatures.get(name) != new_signatures.get(name)}
+
+            identity = self._get_book_identity(self.path, epub_zip)
+
+            nav_path = self._get_nav_path(self.resources, self.toc_path)
+            if (self.opf_path in changed
+                    or 'META-INF/container.xml' in changed
+                    or nav_path in changed):
+                index = self._read_index(self.path, epub_zip)
+            else:
+                index = self._get_index()
+                self._update_resources_sizes(index, epub_zip, changed)
+
+            index['identity'] = identity
+            if self.index_cache is not None:
+                self.index_cache.save(self.path, identity,
+                                      self._index_to_cache(index))
         except BookError:
-            raise BookError(0, _('Could not read OPF file'), epub_path)
+            epub_zip.close()
+            raise
+        except ARCHIVE_ERRORS as e:
+            epub_zip.close()
+            raise BookError(0, _('Could not read zip format'),
+                            self.path) from e
+
+        key_map = {(self.book_identity, path): (identity, path)
+                   for path in self.resources
+                   if path not in changed}
+        self.resource_cache.rename(key_map)
+        for path in changed:
+            self.resource_cache.remove((self.book_identity, path))
+
+        current_path = self.get_current_path() if self.spine_primary else ''
+        self._set_book(self.path, epub_zip, index)
+
+        if current_path in self.spine_primary:
+            self.__current = self.spine_primary.index(current_path)
+        else:
+            self.__current = max(min(self.__current,
+                                     len(self.spine_primary) - 1), 0)
 
-        opf_mime = 'application/oebps-package+xml'
-        opf_elem = self._bytes_to_elem(opf_content, opf_mime)
-        opf_elem = opf_elem.getroot()
+        return changed
 
-        self.version = opf_elem.get('version')
-        self.metadata = self._get_opf_metadata(opf_elem)
-        self.identifier = self.metadata.get('identifier', [''])[0]
-        self.title = self.metadata.get('title', [''])[0]
-        self.language = self.metadata.get('language', [''])[0]
+    def release_mapping(self):
+        """
+        Stop serving resources from a memory mapping of the epub file, to
+        be called as soon as the file is known to change on disk
+        """
+        if self.__zip is not None:
+            self.__zip.release_mapping()
 
-        opf_resources = self._get_opf_resources(opf_path, opf_elem, epub_zip)
-        self.resources = opf_resources[0]
-        self.resources_by_id = opf_resources[1]
-        self.cover_doc = ''
-        self.cover = ''
+    def save_caches(self):
+        """
+        Store the dependencies and notes found since they were last stored
+        """
+        if self.save_caches_source_id:
+            GLib.source_remove(self.save_caches_source_id)
+            self.save_caches_source_id = 0
 
-        # TODO: Cover EPUB2 (from OPF manifest)
-        #         img_types = [
-        #             'image/gif',
-        #             'image/jpeg',
-        #             'image/jpg',
-        #             'image/png',
-        #             'image/svg+xml'
-        #         ]
-        #         if res_type in img_types:
-        #             if 'cover-image' in res_props:
-        #                 self.cover_img = res_path
-        #
-        # TODO: Cover EPUB3 (from OPF manifest)
-        #         if res_type == 'application/xhtml+xml':
-        #             elif 'cover' in res_props:
-        #                 self.cover_doc = res_path
-        #
-        # TODO: Cover EPUB3 (from guide)
-        #                 if ref_type == 'cover':
-        #                     if not self.cover_doc:
-        #                         self.cover_doc = ref_href
-
-        self.direction = self._get_opf_progression_direction(opf_elem)
-        self.spine_primary, self.spine_auxiliary = self._get_opf_spine(opf_elem)
-        self.guide = self._get_opf_guide(opf_path, opf_elem)
-        # TODO: self.navigation = self._get_opf_navigation(opf_elem)
-        self.pages_positions = self._calculate_pages_positions()
-
-        self.toc_path = self._get_toc_path(opf_elem)
-        self.path = epub_path
+        if self.unsaved_dependencies and self.dependency_cache is not None:
+            self.dependency_cache.save(self.path,
+                                       self.book_identity,
+                                       self.dependencies)
+        self.unsaved_dependencies = False
+
+        if self.unsaved_notes and self.notes_cache is not None:
+            self.notes_cache.save(self.path, self.book_identity, self.notes)
+        self.unsaved_notes = False
+
+    def close(self):
+        """
+        Close the archive of the currently opened epub file, if any, and
+        store the dependencies and notes found while it was open
+        """
+        self.save_caches()
+        if self.__zip is not None:
+            self.__zip.close()
+            self.__zip = None
 
     def get_toc(self) -> list:
         """
@@ -185,30 +464,217 @@ class Epub(GObject.GObject):
 
     def get_resource_id(self, path: str) -> str:
         try:
-            return self.resources[path]['id']
+            return self.resources[path].id
         except KeyError as e:
             self._raise_resource_not_found(e.args[0])
 
     def get_resource_content(self, path: str) -> bytes:
+        """
+        Obtain the content of the given resource path, from the resource
+        cache or reading it from the archive
+
+        :param path: A path of a resource
+        :return: The content of the resource
+        """
+        if path not in self.resources:
+            self._raise_resource_not_found(path)
+
+        key = (self.book_identity, path)
+        content = self.resource_cache.get(key)
+
+        if content is None:
+            content = self._read_inner_zip_path(self.__zip, path)
+            self.resource_cache.put(key, content)
+
+        return content
+
+    def get_resource_contents(self, paths) -> dict:
+        """
+        Obtain the content of several resources, inflating the ones that
+        are not in the resource cache at the same time
+
+        :param paths: An iterable with paths of resources
+        :return: A dictionary with the content of the resources by path
+        """
+        contents = {}
+        missing = []
+
+        for path in paths:
+            if path not in self.resources:
+                self._raise_resource_not_found(path)
+
+            content = self.resource_cache.get((self.book_identity, path))
+            if content is None:
+                missing.append(path)
+            else:
+                contents[path] = content
+
         try:
-            return self.resources[path]['content']
+            read_contents = self.__zip.read_many(missing)
+        except KeyError as e:
+            self._raise_resource_not_found(e.args[0])
+
+        for path, content in read_contents.items():
+            self.resource_cache.put((self.book_identity, path), content)
+
+        contents.update(read_contents)
+
+        return contents
+
+    def get_resource_bytes(self, path: str) -> GLib.Bytes:
+        """
+        Obtain the content of the given resource path as a GLib.Bytes
+
+        Resources stored uncompressed in the archive are not copied.
+
+        :param path: A path of a resource
+        :return: A GLib.Bytes object with the content of the resource
+        """
+        if path not in self.resources:
+            self._raise_resource_not_found(path)
+
+        if self.__zip.is_stored(path):
+            return self.__zip.get_bytes(path)
+
+        return GLib.Bytes(self.get_resource_content(path))
+
+    def open_resource(self, path: str):
+        """
+        Open a resource for reading it in pieces, without holding all of
+        its content in memory
+
+        :param path: A path of a resource
+        :return: A seekable binary file object, to be closed by the caller
+        """
+        if path not in self.resources:
+            self._raise_resource_not_found(path)
+
+        try:
+            return self.__zip.open(path)
+        except KeyError as e:
+            self._raise_resource_not_found(e.args[0])
+
+    def get_resource_size(self, path: str) -> int:
+        try:
+            return self.resources[path].size
         except KeyError as e:
             self._raise_resource_not_found(e.args[0])
 
     def get_resource_mime(self, path: str) -> str:
         try:
-            return self.resources[path]['mimetype']
+            return self.resources[path].mimetype
         except KeyError as e:
             self._raise_resource_not_found(e.args[0])
 
     def get_resource_with_epub_uris(self, resource_path):
-        content = self.get_resource_content(resource_path)
-        mimetype = self.get_resource_mime(resource_path)
-        replace = self._replace_uris(resource_path, content, mimetype)
+        """
+        Obtain the content of a document with its URIs pointing to the epub
+        scheme. Rewritten documents are kept in memory by rendered_cache,
+        and on disk by the chapter cache.
+
+        :param resource_path: A path of a document
+        :return: The rewritten content of the document
+        """
+        key = (self.book_identity, resource_path)
+        replace = self.rendered_cache.get(key)
+        if replace is not None:
+            return replace
+
+        replace = self.chapter_cache.load(self.book_identity, resource_path)
+        if replace is None:
+            content = self.get_resource_content(resource_path)
+            mimetype = self.get_resource_mime(resource_path)
+            replace = self._replace_uris(resource_path, content, mimetype)
+            self.chapter_cache.save(self.book_identity, resource_path,
+                                    replace)
+
+        self.rendered_cache.put(key, replace)
+
         return replace
 
+    def get_dependencies(self, path: str) -> tuple:
+        """
+        Obtain the resources a document or stylesheet makes the view load:
+        stylesheets, images, fonts and media, following the stylesheets.
+        The dependencies are computed once per version of the book.
+
+        :param path: A path of a resource
+        :return: A tuple with the paths of the resources in the order they
+            are referenced
+        """
+        dependencies = self.dependencies.get(path)
+        if dependencies is not None:
+            return tuple(dependencies)
+
+        dependencies = []
+        pending = [path]
+        visited = {path}
+
+        while pending:
+            resource_path = pending.pop(0)
+            for dependency in self._get_direct_dependencies(resource_path):
+                if dependency not in visited:
+                    visited.add(dependency)
+                    dependencies.append(dependency)
+                    pending.append(dependency)
+
+        self.dependencies[path] = dependencies
+        if self.dependency_cache is not None:
+            self.unsaved_dependencies = True
+            self._save_caches_later()
+
+        return tuple(dependencies)
+
+    def get_links(self, path: str) -> tuple:
+        """
+        Obtain the resources a document links to, like the target of a
+        footnote or of a table of contents entry
+
+        :param path: A path of a resource
+        :return: A tuple with the paths of the linked resources, without
+            repetitions, in the order they are referenced
+        """
+        mimetype = self.get_resource_mime(path)
+        if not (self._is_ops_document(mimetype) or mimetype.endswith('xml')):
+            return ()
+
+        content = self.get_resource_content(path)
+        elem = self._bytes_to_elem(content, mimetype)
+        links = []
+
+        for tag, attr in LINK_ATTRIBUTES:
+            for e in elem.iter('{*}' + tag):
+                href = e.get(attr)
+                if not href:
+                    continue
+
+                href_path = resolve_href_path(path, href)
+                if (href_path in self.resources and href_path != path
+                        and href_path not in links):
+                    links.append(href_path)
+
+        return tuple(links)
+
+    def prefetch(self, path: str, rewrite: bool = True) -> None:
+        """
+        Read into the resource cache a document and the compressed
+        resources it depends on, and rewrite the document into the
+        rendered cache, before the view asks for them
+
+        :param path: A path of a document
+        :param rewrite: Whether the view will load the document with its
+            URIs rewritten, see get_resource_with_epub_uris()
+        """
+        self.get_resource_contents(
+            resource_path
+            for resource_path in (path,) + self.get_dependencies(path)
+            if not self.__zip.is_stored(resource_path))
+
+        if rewrite and self._is_ops_document(self.get_resource_mime(path)):
+            self.get_resource_with_epub_uris(path)
+
     def is_page(self, path):
-        if (path in self.spine_primary or path in self.spine_auxiliary):
+        if path in self.spine_primary or path in self.spine_auxiliary:
             return True
 
         return False
@@ -292,30 +758,154 @@ class Epub(GObject.GObject):
 
         return self.pages_positions[self.__current + 1]
 
+    def find_page_label(self, label: str):
+        """
+        Find where a printed page starts, or the closest numbered page
+        before it when the page is not listed
+
+        :param label: A page label, like '347' or 'xiv'
+        :return: A (path, fragment) tuple or None
+        """
+        return self.page_list.find(label, nearest=True)
+
     def get_metadata(self, _id):
         return self.metadata.get(_id)
 
     def find_text(self, search_text):
         found_list = []
-        found = False
+        search_text = search_text.lower()
 
         for path in self.spine_primary:
-            res = self.get_resource_content(path)
-            res_mime = self.get_resource_mime(path)
-            res_elem = self._bytes_to_elem(res, res_mime)
-            res_body = res_elem.xpath('//*[local-name() = "body"]')
+            found = search_text in self.get_text(path).lower()
+            found_list.append([path, found])
 
-            for body in res_body:
-                body_text = ''
-                for child in body.iter():
-                    if child.text and not isinstance(child, etree._Comment):
-                        body_text += child.text
+        return found_list
 
-                found = search_text.lower() in body_text.lower()
+    def get_text(self, path: str) -> str:
+        """
+        Extract the readable text of a document, one line per paragraph
 
-            found_list.append([path, found])
+        The document is read from the archive without going through the
+        resource cache, so walking a whole book does not fill it.
 
-        return found_list
+        :param path: A path of a document
+        :return: The text of the body of the document
+        """
+        if path not in self.resources:
+            self._raise_resource_not_found(path)
+
+        content = self._read_inner_zip_path(self.__zip, path)
+
+        return self._get_document_text(path, content)
+
+    def get_note(self, path: str, fragment: str):
+        """
+        Obtain the text of the note a link points to
+
+        :param path: The path of the document the link points to
+        :param fragment: The fragment of the link
+        :return: The text of the note, or None when the link does not point
+            to a note
+        """
+        if not fragment or path not in self.resources:
+            return None
+
+        return self.get_notes(path).get(fragment)
+
+    def get_notes(self, path: str) -> dict:
+        """
+        Obtain the footnotes and endnotes of a document: the elements marked
+        as notes with epub:type or role, and the ones with the ids usually
+        given to notes. The notes are found once per version of the book.
+
+        :param path: A path of a resource
+        :return: A dictionary with the text of the notes by id
+        """
+        notes = self.notes.get(path)
+        if notes is not None:
+            return notes
+
+        notes = {}
+        mimetype = self.get_resource_mime(path)
+
+        if self._is_ops_document(mimetype):
+            content = self.get_resource_content(path)
+            elem = self._bytes_to_elem(content, mimetype)
+
+            for e in elem.iter():
+                note_id = e.get('id') if isinstance(e.tag, str) else None
+                if not note_id or note_id in notes:
+                    continue
+
+                types = set(e.get(EPUB + 'type', '').split())
+                types.update(e.get('role', '').split())
+                if types & NOTEREF_TYPES:
+                    continue
+
+                if types & NOTE_TYPES:
+                    note_elem = e
+                elif NOTE_ID.match(note_id):
+                    note_elem = self._get_block_elem(e)
+                else:
+                    continue
+
+                text = self._get_elem_text(note_elem)
+                if text:
+                    notes[note_id] = text
+
+        self.notes[path] = notes
+        if self.notes_cache is not None:
+            self.unsaved_notes = True
+            self._save_caches_later()
+
+        return notes
+
+    def get_media_overlay(self, path: str) -> MediaOverlay:
+        """
+        Obtain the timing of the narration of a document, from the SMIL
+        file of its media overlay. Each document is parsed once.
+
+        :param path: A path of a document
+        :return: A MediaOverlay object, empty when the document is not
+            narrated
+        """
+        overlay = self.media_overlays.get(path)
+        if overlay is not None:
+            return overlay
+
+        if path not in self.resources:
+            self._raise_resource_not_found(path)
+
+        smil_path = self.resources_by_id.get(
+            self.resources[path].media_overlay)
+        if smil_path:
+            overlay = self._read_media_overlay(path, smil_path)
+        else:
+            overlay = MediaOverlay()
+
+        self.media_overlays[path] = overlay
+
+        return overlay
+
+    def iter_text(self):
+        """
+        Walk the primary spine and extract the readable text of each
+        document. Documents are inflated a few at a time, so memory use
+        does not grow with the size of the book.
+
+        :return: A generator of (path, text) tuples in reading order
+        """
+        paths = list(self.spine_primary)
+
+        for i in range(0, len(paths), TEXT_BATCH_SIZE):
+            batch = paths[i:i + TEXT_BATCH_SIZE]
+            try:
+                contents = self.__zip.read_many(batch)
+            except KeyError as e:
+                self._raise_resource_not_found(e.args[0])
+
+            for path in batch:
+                yield path, self._get_document_text(path, contents[path])
 
     # Internal functions #
 
@@ -330,21 +920,19 @@ class Epub(GObject.GObject):
 
         return True
 
-    def _open_zip_archive(self, zip_path):
+    def _open_zip_archive(self, zip_path, resident=False):
         """
         Open a zip file from the given path
 
         :param zip_path: A string containing the path to the file
-        :return: A zipfile.ZipFile object or None
+        :param resident: Whether to keep the file in memory
+        :return: A ZipContainer object or None
         """
         epub_zip = None
 
         try:
-            epub_zip = zipfile.ZipFile(zip_path,
-                                       'r',
-                                       compression=zipfile.ZIP_DEFLATED,
-                                       allowZip64=True)
-        except (zipfile.BadZipFile, zipfile.LargeZipFile):
+            epub_zip = ZipContainer(zip_path, resident)
+        except (zipfile.BadZipFile, zipfile.LargeZipFile, OSError):
             pass
 
         return epub_zip
@@ -353,7 +941,7 @@ class Epub(GObject.GObject):
         """
         Read a file inside a zip object
 
-        :param epub_zip: A zipfile.ZipFile object
+        :param epub_zip: A ZipContainer object
         :param inner_path: A string representing a path
         :return: A python bytes string or None
         """
@@ -364,11 +952,456 @@ class Epub(GObject.GObject):
 
         return path_bytes
 
+    def _get_inner_zip_info(self, epub_zip, inner_path):
+        """
+        Get the information of a file inside a zip object without reading it
+
+        :param epub_zip: A ZipContainer object
+        :param inner_path: A string representing a path
+        :return: A zipfile.ZipInfo object
+        """
+        try:
+            path_info = epub_zip.getinfo(inner_path)
+        except KeyError:
+            self._raise_resource_not_found(inner_path)
+
+        return path_info
+
+    def _load(self, epub_path, cancellable=None, progress=None,
+              progressive=False):
+        """
+        Open the archive of an epub file and get its index, from the cache
+        when possible. The currently opened book is not modified.
+
+        An index that is not cached is only read far enough to show the
+        book, it must be completed with _complete_index(). A progressive
+        load also leaves keeping the file in memory for later.
+
+        :param epub_path: The path to the epub file
+        :param cancellable: A Gio.Cancellable object or None
+        :param progress: A function receiving the fraction done, or None
+        :param progressive: Whether to open the file without reading it
+            into memory
+        :return: A tuple with a ZipContainer object, the index and the
+            navigation document as given by _read_nav(), or None when the
+            index is complete
+        :raises BookError: When the file or format is incorrect.
+        :raises GLib.Error: When the operation was cancelled.
+        """
+        if progress is not None:
+            progress(0.0)
+
+        resident = self.keep_compressed and not progressive
+        epub_zip = self._open_epub_archive(epub_path, resident)
+        nav = None
+
+        try:
+            identity = self._get_book_identity(epub_path, epub_zip)
+            cached_index = None
+            if self.index_cache is not None:
+                cached_index = self.index_cache.load(epub_path, identity)
+
+            if cached_index is not None:
+                index = self._index_from_cache(cached_index)
+            else:
+                index = self._read_partial_index(epub_path, epub_zip,
+                                                 cancellable, progress)
+                nav = self._read_nav(epub_zip, index)
+                self._check_cancelled(cancellable)
+        except Exception:
+            epub_zip.close()
+            raise
+
+        index['identity'] = identity
+
+        if progress is not None:
+            progress(1.0)
+
+        return epub_zip, index, nav
+
+    def _complete_index(self, epub_path, index, nav):
+        """
+        Add the page list and the landmarks to an index read by _load(),
+        and store it in the index cache
+
+        :param epub_path: The path to the epub file
+        :param index: A dictionary as returned by _read_partial_index()
+        :param nav: A tuple as returned by _read_nav()
+        """
+        index['page_list'], index['navigation'] = \
+            self._get_nav_page_list_landmarks(nav[0], nav[1],
+                                              index['resources'])
+
+        if self.index_cache is not None:
+            self.index_cache.save(epub_path, index['identity'],
+                                  self._index_to_cache(index))
+
+    def _complete_index_async(self, epub_path, cancellable, index, nav):
+        """
+        Complete the index of a book opened with open_async(), in its
+        worker thread, and apply it once the book is the current one
+
+        :param epub_path: The path to the epub file
+        :param cancellable: A Gio.Cancellable object or None
+        :param index: A copy of the index given to open_finish()
+        :param nav: A tuple as returned by _read_nav(), or None when the
+            index is complete
+        """
+        resident_zip = None
+
+        try:
+            if nav is not None:
+                self._check_cancelled(cancellable)
+                self._complete_index(epub_path, index, nav)
+
+            if (self.keep_compressed
+                    and GLib.file_test(epub_path, GLib.FileTest.IS_REGULAR)):
+                self._check_cancelled(cancellable)
+                resident_zip = self._open_zip_archive(epub_path, True)
+        except Exception as e:
+            logger.info('Could not complete index:' + str(e))
+            return
+
+        if nav is None and resident_zip is None:
+            return
+
+        def apply():
+            if (self.path != epub_path
+                    or self.book_identity != index['identity']):
+                # Another book or version was opened in the meantime
+                if resident_zip is not None:
+                    resident_zip.close()
+                return False
+
+            if nav is not None:
+                self.page_list = index['page_list']
+                self.navigation = index['navigation']
+
+            if resident_zip is not None:
+                if (self._get_book_identity(epub_path, resident_zip)
+                        == self.book_identity):
+                    self.close()
+                    self.__zip = resident_zip
+                else:
+                    resident_zip.close()
+
+            return False
+
+        GLib.idle_add(apply)
+
+    def _read_index(self, epub_path, epub_zip, cancellable=None,
+                    progress=None):
+        """
+        Parse the container, the OPF file and everything derived from them
+
+        :param epub_path: The path to the epub file
+        :param epub_zip: A ZipContainer object
+        :param cancellable: A Gio.Cancellable object or None
+        :param progress: A function receiving the fraction done, or None
+        :return: A dictionary with the index of the book
+        :raises BookError: When the OPF file is broken or missing
+        :raises GLib.Error: When the operation was cancelled.
+        """
+        index = self._read_partial_index(epub_path, epub_zip,
+                                         cancellable, progress)
+        nav_path, nav_content = self._read_nav(epub_zip, index)
+
+        index['page_list'], index['navigation'] = \
+            self._get_nav_page_list_landmarks(nav_path, nav_content,
+                                              index['resources'])
+
+        return index
+
+    def _read_partial_index(self, epub_path, epub_zip, cancellable=None,
+                            progress=None):
+        """
+        Parse the container and the OPF file, which is enough to show any
+        document of the book. The page list and the landmarks are left
+        empty.
+
+        :param epub_path: The path to the epub file
+        :param epub_zip: A ZipContainer object
+        :param cancellable: A Gio.Cancellable object or None
+        :param progress: A function receiving the fraction done, or None
+        :return: A dictionary with the index of the book
+        :raises BookError: When the OPF file is broken or missing
+        :raises GLib.Error: When the operation was cancelled.
+        """
+        opf_path, opf_content = self._read_opf(epub_path, epub_zip)
+        self._check_cancelled(cancellable)
+        if progress is not None:
+            progress(0.2)
+
+        index = self._parse_opf(opf_path, opf_content, epub_zip,
+                                cancellable, progress)
+
+        index['navigation'] = []
+        index['page_list'] = PageList()
+        index['pages_positions'] = self._calculate_pages_positions(
+            index['spine_primary'], index['resources'])
+        index['opf_path'] = opf_path
+
+        return index
+
+    def _read_nav(self, epub_zip, index):
+        """
+        Read the navigation document of an index, or its NCX, without
+        parsing it
+
+        :param epub_zip: A ZipContainer object
+        :param index: A dictionary as returned by _read_partial_index()
+        :return: A tuple with the path and the content of the document, or
+            an empty path and content when there is none
+        :raises BookError: When the document is missing from the archive
+        """
+        nav_path = self._get_nav_path(index['resources'], index['toc_path'])
+        if nav_path not in index['resources']:
+            return '', b''
+
+        return nav_path, self._read_inner_zip_path(epub_zip, nav_path)
+
+    def _save_caches_later(self):
+        """
+        Store the dependencies and notes a few seconds from now, along with
+        any other found in the meantime
+        """
+        if not self.save_caches_source_id:
+            self.save_caches_source_id = GLib.timeout_add_seconds(
+                CACHE_SAVE_DELAY, self._on_save_caches_timeout)
+
+    def _on_save_caches_timeout(self):
+        self.save_caches_source_id = 0
+        self.save_caches()
+
+        return False
+
+    def _set_book(self, epub_path, epub_zip, index):
+        """
+        Make the given archive and index the currently opened book
+
+        :param epub_path: The path to the epub file
+        :param epub_zip: A ZipContainer object
+        :param index: A dictionary as returned by _read_index()
+        """
+        self.save_caches()
+        self._set_index(index)
+        self.path = epub_path
+
+        dependencies = None
+        if self.dependency_cache is not None:
+            dependencies = self.dependency_cache.load(epub_path,
+                                                      self.book_identity)
+        self.dependencies = dependencies or {}
+        notes = None
+        if self.notes_cache is not None:
+            notes = self.notes_cache.load(epub_path, self.book_identity)
+        self.notes = notes or {}
+        self.media_overlays = {}
+
+        # The archive stays open for the lifetime of the book, resources are
+        # inflated the first time they are requested.
+        self.close()
+        self.__zip = epub_zip
+
+    def _update_resources_sizes(self, index, epub_zip, changed):
+        """
+        Refresh the sizes of the changed resources of an index, and the
+        page positions that depend on them
+
+        :param index: A dictionary as returned by _read_index()
+        :param epub_zip: The ZipContainer object the index belongs to
+        :param changed: A set with the paths of the changed members
+        :raises BookError: When a resource is missing from the archive
+        """
+        resources = dict(index['resources'])
+
+        for path in changed:
+            resource = resources.get(path)
+            if resource is None:
+                continue
+
+            res_info = self._get_inner_zip_info(epub_zip, path)
+            resources[path] = ManifestItem(resource.id,
+                                           resource.mimetype,
+                                           resource.properties,
+                                           res_info.file_size,
+                                           resource.media_overlay)
+
+        index['resources'] = resources
+        index['pages_positions'] = self._calculate_pages_positions(
+            index['spine_primary'], resources)
+
+    def _check_cancelled(self, cancellable):
+        """
+        Stop the current operation if it was cancelled
+
+        :param cancellable: A Gio.Cancellable object or None
+        :raises GLib.Error: When the operation was cancelled.
+        """
+        if cancellable is not None:
+            cancellable.set_error_if_cancelled()
+
+    def _open_epub_archive(self, epub_path, resident=False):
+        """
+        Open the archive of an epub file, or an unpacked epub directory,
+        and check its mimetype
+
+        :param epub_path: The path to the epub file or directory
+        :param resident: Whether to keep an epub file in memory
+        :return: A ZipContainer or DirectoryContainer object
+        :raises BookError: When the file or format is incorrect.
+        """
+        if not GLib.file_test(epub_path, GLib.FileTest.EXISTS):
+            raise BookError(0, _('File does not exist'), epub_path)
+
+        if GLib.file_test(epub_path, GLib.FileTest.IS_DIR):
+            epub_zip = DirectoryContainer(epub_path)
+        elif GLib.file_test(epub_path, GLib.FileTest.IS_REGULAR):
+            epub_zip = self._open_zip_archive(epub_path, resident)
+        else:
+            raise BookError(0, _('Unrecognized file format'), epub_path)
+
+        if epub_zip is None:
+            raise BookError(0, _('Could not read zip format'), epub_path)
+
+        if not self._has_epub_mime(epub_zip):
+            epub_zip.close()
+            raise BookError(0, _('Unrecognized file format'), epub_path)
+
+        return epub_zip
+
+    def _read_opf(self, epub_path, epub_zip):
+        """
+        Find and read the OPF file
+
+        :param epub_path: The path to the epub file
+        :param epub_zip: A ZipContainer object
+        :return: A tuple with the OPF file path and its content
+        :raises BookError: When the OPF file is broken or missing
+        """
+        try:
+            opf_path = self._read_opf_path(epub_zip)
+            if opf_path is None:
+                raise BookError(0, '')
+        except BookError:
+            raise BookError(0, _('Broken or missing OPF file'), epub_path)
+
+        try:
+            opf_content = self._read_inner_zip_path(epub_zip, opf_path)
+        except BookError:
+            raise BookError(0, _('Could not read OPF file'), epub_path)
+
+        return opf_path, opf_content
+
+    def _get_book_identity(self, epub_path, epub_zip):
+        """
+        Identify the current version of the epub file
+
+        :param epub_path: The path to the epub file
+        :param epub_zip: A ZipContainer object
+        :return: A string that changes whenever the file changes
+        """
+        return get_book_identity(epub_path, epub_zip.get_directory_hash())
+
+    def _index_to_cache(self, index):
+        """
+        Convert an index to a form that can be stored in the index cache
+
+        :param index: A dictionary as returned by _read_index()
+        :return: A dictionary that can be serialized to JSON
+        """
+        cached_index = dict(index)
+        cached_index.pop('identity', None)
+
+        cached_index['resources'] = {path: resource.to_list()
+                                     for path, resource
+                                     in index['resources'].items()}
+        cached_index['spine_primary'] = index['spine_primary'].to_list()
+        cached_index['spine_auxiliary'] = index['spine_auxiliary'].to_list()
+        cached_index['page_list'] = index['page_list'].to_list()
+
+        return cached_index
+
+    def _index_from_cache(self, cached_index):
+        """
+        Convert an index loaded from the index cache back to its usual form
+
+        :param cached_index: A dictionary as returned by _index_to_cache()
+        :return: A dictionary like the ones returned by _read_index()
+        """
+        index = dict(cached_index)
+
+        index['resources'] = {sys.intern(path): ManifestItem.from_list(fields)
+                              for path, fields
+                              in cached_index['resources'].items()}
+        index['spine_primary'] = Spine(cached_index['spine_primary'])
+        index['spine_auxiliary'] = Spine(cached_index['spine_auxiliary'])
+        index['guide'] = [tuple(reference)
+                          for reference in cached_index['guide']]
+        index['navigation'] = [tuple(reference)
+                               for reference in cached_index['navigation']]
+        index['page_list'] = PageList(cached_index['page_list'])
+
+        return index
+
+    def _set_index(self, index):
+        """
+        Use the given index as the one of the current book
+
+        :param index: A dictionary as returned by _read_index()
+        """
+        self.book_identity = index['identity']
+        self.version = index['version']
+        self.metadata = index['metadata']
+        self.identifier = self.metadata.get('identifier', [''])[0]
+        self.title = self.metadata.get('title', [''])[0]
+        self.language = self.metadata.get('language', [''])[0]
+
+        self.resources = index['resources']
+        self.resources_by_id = index['resources_by_id']
+        self.cover_doc = index['cover_doc']
+        self.cover = index['cover']
+
+        self.direction = index['direction']
+        self.spine_primary = index['spine_primary']
+        self.spine_auxiliary = index['spine_auxiliary']
+        self.guide = index['guide']
+        self.navigation = index['navigation']
+        self.page_list = index['page_list']
+        self.pages_positions = index['pages_positions']
+        self.toc_path = index['toc_path']
+        self.opf_path = index['opf_path']
+
+    def _get_index(self):
+        """
+        Get the index of the current book
+
+        :return: A dictionary like the ones returned by _read_index()
+        """
+        return {
+            'identity': self.book_identity,
+            'version': self.version,
+            'metadata': self.metadata,
+            'resources': self.resources,
+            'resources_by_id': self.resources_by_id,
+            'direction': self.direction,
+            'spine_primary': self.spine_primary,
+            'spine_auxiliary': self.spine_auxiliary,
+            'guide': self.guide,
+            'cover': self.cover,
+            'cover_doc': self.cover_doc,
+            'navigation': self.navigation,
+            'page_list': self.page_list,
+            'pages_positions': self.pages_positions,
+            'toc_path': self.toc_path,
+            'opf_path': self.opf_path
+        }
+
     def _has_epub_mime(self, epub_zip):
         """
         Check if the zip file contains a correct epub mimetype file
 
-        :param epub_zip: A zipfile.ZipFile object
+        :param epub_zip: A ZipContainer object
         :return: True or False
         """
         mimetype = None
@@ -387,7 +1420,7 @@ class Epub(GObject.GObject):
         """
         Find the OPF file path
 
-        :param epub_zip: A zipfile.ZipFile object
+        :param epub_zip: A ZipContainer object
         :return: A string pointing to the OPF file inside the zip file or None
         """
         # <rootfiles>
@@ -408,223 +1441,346 @@ class Epub(GObject.GObject):
 
         return opf_path
 
-    def _get_opf_metadata(self, opf_elem):
+    def _parse_opf(self, opf_path, opf_content, epub_zip, cancellable=None,
+                   progress=None):
         """
-        Get all metadata elements inside the OPF file
+        Read the OPF file in a single pass
+
+        The file is parsed incrementally: metadata, manifest items, spine
+        items and guide references are taken as they are parsed and then
+        dropped, so memory use does not depend on the size of the tree.
 
-        :param opf_elem: A lxml.etree object
-        :return: A dictionary containing the metadata
+        :param opf_path: The original OPF file path
+        :param opf_content: The content of the OPF file
+        :param epub_zip: A ZipContainer object
+        :param cancellable: A Gio.Cancellable object or None
+        :param progress: A function receiving the fraction done, or None
+        :return: A dictionary with the version, metadata, resources,
+            resources_by_id, spine_primary, spine_auxiliary, direction,
+            toc_path, guide, cover and cover_doc of the book
+        :raises BookError: When the OPF file is broken or a resource is
+            missing
+        :raises GLib.Error: When the operation was cancelled.
         """
-        # <package … unique-identifier="pub-id">
-        #     …
+        # <package version="3.0" unique-identifier="pub-id">
         #     <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
         #         <dc:identifier id="pub-id">urn:uuid:A1B0D67E</dc:identifier>
         #         <dc:title>Norwegian Wood</dc:title>
-        #         <dc:language>en</dc:language>
-        #         <meta property="dcterms:modified">2011-01-01T12:00:00Z</meta>
+        #         <meta name="cover" content="img"/>
         #     </metadata>
-        #     …
+        #     <manifest>
+        #         <item id="img" href="cover.jpg" media-type="image/jpeg"
+        #               properties="cover-image"/>
+        #         <item id="c1" href="c1.xhtml"
+        #               media-type="application/xhtml+xml"/>
+        #     </manifest>
+        #     <spine toc="ncx" page-progression-direction="ltr">
+        #         <itemref idref="c1"/>
+        #     </spine>
+        #     <guide>
+        #         <reference type="cover" title="Cover" href="c1.xhtml"/>
+        #     </guide>
         # </package>
-        metadata_elem = opf_elem.find(OPF + 'metadata')
-        metadata = {}
+        #
+        # TODO: Check OPS Core Media Types, do not render img or object
+        # elements of unsupported media types in the absence of fallbacks.
+        opf_dir_path = posixpath.dirname(opf_path)
+        opf_length = max(len(opf_content), 1)
+        opf_stream = io.BytesIO(opf_content)
+
+        opf = {'version': None,
+               'metadata': {},
+               'resources': {},
+               'resources_by_id': {},
+               'direction': 'default',
+               'guide': []}
+        resources = opf['resources']
+        resources_by_id = opf['resources_by_id']
+        itemrefs = []
+        toc_id = None
+        cover = ''
+        cover_id = None
+        cover_doc = ''
+
+        parser_events = etree.iterparse(opf_stream,
+                                        remove_comments=True,
+                                        remove_pis=True,
+                                        recover=True)
+
+        try:
+            for event, elem in parser_events:
+                # Only the children of the elements are dropped, so their
+                # attributes are still there when they end
+                if elem.tag == OPF + 'package':
+                    opf['version'] = elem.get('version')
+                    continue
+                elif elem.tag == OPF + 'spine':
+                    toc_id = elem.get('toc')
+                    opf['direction'] = elem.get(
+                        'page-progression-direction') or 'default'
+                    continue
 
-        for child in metadata_elem:
-            if not etree.iselement(child) or child.tag is etree.Comment:
+                parent = elem.getparent()
+                parent_tag = parent.tag if parent is not None else None
+
+                if parent_tag == OPF + 'metadata':
+                    tag = elem.tag[elem.tag.rfind('}') + 1:]
+                    if elem.prefix and elem.prefix.lower() == 'dc':
+                        opf['metadata'].setdefault(tag, []).append(elem.text)
+                    elif tag == 'meta' and elem.get('name') == 'cover':
+                        cover_id = elem.get('content')
+                elif (elem.tag == OPF + 'item'
+                      and parent_tag == OPF + 'manifest'):
+                    if len(resources) % 256 == 0:
+                        self._check_cancelled(cancellable)
+                        if progress is not None:
+                            fraction = opf_stream.tell() / opf_length
+                            progress(0.2 + 0.7 * fraction)
+
+                    res_props = elem.get('properties', '').split()
+                    res_type = elem.get('media-type')
+                    res_inner_path = decode_uri(elem.get('href'))
+                    res_path = sys.intern(posixpath.join(opf_dir_path,
+                                                         res_inner_path))
+                    res_info = self._get_inner_zip_info(epub_zip, res_path)
+
+                    resource = ManifestItem(elem.get('id'),
+                                            res_type,
+                                            res_props,
+                                            res_info.file_size,
+                                            elem.get('media-overlay'))
+                    resources[res_path] = resource
+                    resources_by_id[resource.id] = res_path
+
+                    if 'cover-image' in res_props and not cover:
+                        cover = res_path
+                    if ('cover' in res_props and not cover_doc
+                            and res_type == 'application/xhtml+xml'):
+                        cover_doc = res_path
+                elif (elem.tag == OPF + 'itemref'
+                      and parent_tag == OPF + 'spine'):
+                    itemrefs.append((elem.get('idref'),
+                                     elem.get('linear', 'yes')))
+                elif (elem.tag == OPF + 'reference'
+                      and parent_tag == OPF + 'guide'):
+                    ref_inner_path = decode_uri(elem.get('href'))
+                    ref_href = posixpath.join(opf_dir_path, ref_inner_path)
+                    opf['guide'].append((ref_href,
+                                         elem.get('title'),
+                                         elem.get('type')))
+                else:
+                    continue
+
+                # Drop the element and the siblings already processed
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+        except etree.XMLSyntaxError:
+            raise BookError(0, _('Broken or missing OPF file'),
+                            epub_zip.path)
+
+        spine_primary = []
+        spine_auxiliary = []
+        for res_id, linear in itemrefs:
+            if res_id not in resources_by_id:
                 continue
 
-            tag = child.tag[child.tag.rfind('}') + 1:]
+            if linear == 'yes':
+                spine_primary.append(resources_by_id[res_id])
+            else:
+                spine_auxiliary.append(resources_by_id[res_id])
+
+        opf['spine_primary'] = Spine(spine_primary)
+        opf['spine_auxiliary'] = Spine(spine_auxiliary)
+        opf['toc_path'] = self._get_toc_path(toc_id, resources,
+                                             resources_by_id)
 
-            if child.prefix and child.prefix.lower() == 'dc':
-                if self.metadata.get(tag, None):
-                    metadata[tag].append(child.text)
-                else:
-                    metadata[tag] = [child.text]
+        if not cover and cover_id:
+            cover = resources_by_id.get(cover_id, '')
+
+        opf['cover'], opf['cover_doc'] = self._get_cover_paths(
+            epub_zip, cover, cover_doc, opf['guide'])
 
-        return metadata
+        return opf
 
-    def _get_opf_resources(self, opf_path, opf_elem, epub_zip):
+    def _get_cover_paths(self, epub_zip, cover, cover_doc, guide):
         """
-        Get all relevant files inside an epub file, using the opf file as
-        reference.
+        Complete the cover image and the cover document found in the
+        manifest
+
+        The document falls back to the guide reference of type 'cover', and
+        the image to the first image of the document.
+
+        :param epub_zip: A ZipContainer object
+        :param cover: The path of the cover image in the manifest or ''
+        :param cover_doc: The path of the cover document in the manifest
+            or ''
+        :param guide: The guide as returned by _parse_opf()
+        :return: A tuple with the paths of the image and of the document,
+            each one may be ''
+        """
+        if not cover_doc:
+            for ref_href, ref_title, ref_type in guide:
+                if ref_type == 'cover':
+                    cover_doc = urllib.parse.urldefrag(ref_href)[0]
+                    break
 
-        :param opf_path: The original OPF file path
-        :param opf_elem: A lxml.etree object
-        :param epub_zip: A zipfile.ZipFile object
-        :return: A tuple containing two dictionaries,
-            the first one containing all epub resources by path {path: (id, …)}
-            and the second containing all resources paths by id {id: path}
-        """
-        # manifest
-        # TODO: Check OPS Core Media Types
-        # MIME Media Type           Description
-        # image/gif                    Used for raster graphics
-        # image/jpeg                Used for raster graphics
-        # image/png                 Used for raster graphics
-        # image/svg+xml             Used for vector graphics
-        # application/xhtml+xml     Used for OPS Content Documents
-        # application/x-dtbook+xml  Used for OPS Content Documents
-        # text/css                  Used for OPS CSS-subset style sheets
-        # application/xml           Used for Out-Of-Line XML Islands
-        # text/x-oeb1-document      Deprecated; OEBPS 1.0.1 and 1.2 Documents
-        # text/x-oeb1-css           Deprecated; OEBPS 1.0.1 and 1.2 CSS
-        # application/x-dtbncx+xml  The NCX
-        #
-        # Do not render img or object elements of unsupported media types,
-        # in the absence of fallbacks.
-        resources = {}
-        resources_by_id = {}
+        if not cover and cover_doc:
+            cover = self._get_first_image_path(epub_zip, cover_doc)
 
-        opf_dir_path = posixpath.dirname(opf_path)
+        return cover, cover_doc
 
-        manifest_elem = opf_elem.find(OPF + 'manifest')
-        for child in manifest_elem:
-            if not etree.iselement(child) and child.tag != OPF + 'item':
-                continue
+    def _get_first_image_path(self, epub_zip, doc_path):
+        """
+        Find the first image shown by a document
+
+        :param epub_zip: A ZipContainer object
+        :param doc_path: A path of a document
+        :return: The path of the image or ''
+        """
+        try:
+            content = self._read_inner_zip_path(epub_zip, doc_path)
+        except BookError:
+            return ''
 
-            if isinstance(child, etree._Comment):
+        elem = self._bytes_to_elem(content, 'application/xhtml+xml')
+
+        for e in elem.iter('{*}img', '{*}image'):
+            href = e.get('src') or e.get(XLINK + 'href') or e.get('href')
+            if not href:
                 continue
 
-            props = child.get('properties', '')
-            if props:
-                res_props = props.split(' ')
-            else:
-                res_props = []
+            href_path = resolve_href_path(doc_path, href)
+            if href_path is None:
+                continue
 
-            res_type = child.get('media-type')
-            res_id = child.get('id')
-            res_inner_path = Soup.URI.decode(child.get('href'))
-            res_path = posixpath.join(opf_dir_path, res_inner_path)
-            res_content = self._read_inner_zip_path(epub_zip, res_path)
+            try:
+                epub_zip.getinfo(href_path)
+            except KeyError:
+                continue
 
-            resources[res_path] = {
-                'id': res_id,
-                'content': res_content,
-                'mimetype': res_type,
-                'properties': res_props
-            }
-            resources_by_id[res_id] = res_path
+            return href_path
 
-        return resources, resources_by_id
+        return ''
 
-    def _get_toc_path(self, opf_elem):
+    def _get_toc_path(self, toc_id, resources, resources_by_id):
         """
         Gets the path of the resource that contains the TOC
 
-        :param opf_elem: A lxml.etree object
+        :param toc_id: The id given by the toc attribute of the spine
+        :param resources: A dictionary of ManifestItem objects by path
+        :param resources_by_id: A dictionary of resource paths by id
         :return: A string containing the path of the TOC resource
         """
         # EPUB2
         # <spine toc="ncx">
         #   <itemref idref="intro" />
         #   <itemref idref="c1" />
-        toc = ''
+        toc = resources_by_id.get(toc_id, '') if toc_id else ''
 
-        spine_elem = opf_elem.find(OPF + 'spine')
-        ncx_id = spine_elem.get('toc')
-
-        if ncx_id:
-            toc = self.resources_by_id[ncx_id]
-
-        if toc or not self.resources:
+        if toc or not resources:
             return toc
 
-        for key in self.resources:
-            resource_properties = self.resources[key]['properties']
-            resource_mimetype = self.resources[key]['mimetype']
+        for key in resources:
+            resource_properties = resources[key].properties
+            resource_mimetype = resources[key].mimetype
             if ('nav' in resource_properties
                 and resource_mimetype == 'application/xhtml+xml'):
-                resource_id = self.resources[key]['id']
-                toc = self.resources_by_id[resource_id]
+                resource_id = resources[key].id
+                toc = resources_by_id[resource_id]
                 break
 
         return toc
 
-    def _get_opf_progression_direction(self, opf_elem):
+    def _get_nav_path(self, resources, toc_path):
         """
-        Gets the direction of the epub file
+        Get the path of the document holding the page list and landmarks:
+        the EPUB3 navigation document, or else the NCX
 
-        :param opf_elem: A lxml.etree object
-        :return: A string with the direction of the document
+        :param resources: A dictionary of ManifestItem objects by path
+        :param toc_path: The path of the TOC resource
+        :return: A string containing a path or ''
         """
-        spine_elem = opf_elem.find(OPF + 'spine')
+        for path, resource in resources.items():
+            if ('nav' in resource.properties
+                    and resource.mimetype == 'application/xhtml+xml'):
+                return path
 
-        ppd = spine_elem.get('page-progression-direction')
-        if ppd:
-            direction = ppd
-        else:
-            direction = 'default'
+        return toc_path
 
-        return direction
-
-    def _get_opf_spine(self, opf_elem):
+    def _get_nav_page_list_landmarks(self, nav_path, nav_bytes, resources):
         """
-        Gets the spine of the epub file
-
-        :param opf_elem: A lxml.etree object
-        :return list: A list of strings with all paths of the spine
+        Read the page list and the landmarks of the navigation document,
+        or the page list of the NCX
+
+        :param nav_path: The path returned by _get_nav_path()
+        :param nav_bytes: The content of the document
+        :param resources: A dictionary of ManifestItem objects by path
+        :return: A tuple with a PageList object and a list of landmarks,
+            in the same (href, title, type) form as the guide
         """
-        spine_primary = []
-        spine_auxiliary = []
-        spine_elem = opf_elem.find(OPF + 'spine')
-
-        for child in spine_elem:
-            if not etree.iselement(child) and child.tag != OPF + 'itemref':
-                continue
-
-            res_id = child.get('idref')
-            linear = child.get('linear', 'yes')
-
-            mimetype = self.resources[self.resources_by_id[res_id]]['mimetype']
-            if not self._is_ops_document(mimetype):
-                pass
+        page_entries = []
+        landmarks = []
 
-            if linear == 'yes':
-                spine_primary.append(self.resources_by_id[res_id])
-            else:
-                spine_auxiliary.append(self.resources_by_id[res_id])
+        if nav_path not in resources:
+            return PageList(), landmarks
 
-        print(spine_primary)
-        print(spine_auxiliary)
+        nav_mime = resources[nav_path].mimetype
+        try:
+            nav_elem = self._bytes_to_elem(nav_bytes, nav_mime)
+        except etree.LxmlError as e:
+            # The book can still be read, only without a page list
+            logger.warning('Could not read navigation document:' + str(e))
+            return PageList(), landmarks
+
+        def get_target(href):
+            if not href:
+                return None
+
+            href_path = resolve_href_path(nav_path, href)
+            if href_path not in resources:
+                return None
+
+            return href_path, urllib.parse.urldefrag(href)[1]
+
+        if nav_elem.getroot().tag == DAISY + 'ncx':
+            # <pageList>
+            #   <pageTarget type="normal" value="1">
+            #     <navLabel><text>1</text></navLabel>
+            #     <content src="chapter1.xhtml#page1"/>
+            xpath_string = '{D}pageList/{D}pageTarget'.format(D=DAISY)
+            for target_elem in nav_elem.iterfind(xpath_string):
+                label = target_elem.findtext(
+                    '{D}navLabel/{D}text'.format(D=DAISY), '').strip()
+                content_elem = target_elem.find(DAISY + 'content')
+                if content_elem is None or not label:
+                    continue
 
-        return spine_primary, spine_auxiliary
+                target = get_target(content_elem.get('src'))
+                if target is not None:
+                    page_entries.append((label,) + target)
 
-    def _get_opf_guide(self, opf_path, opf_elem):
-        """
-        Return a list guide
+            return PageList(page_entries), landmarks
 
-        :param opf_path: The original OPF file path
-        :type opf_path: str
-        :param opf_elem: The tree of the OPF file
-        :type opf_elem: lxml.etree
-        :return: A list with the guide information
-        :rtype: list
-        """
-        guide = []
-        opf_dir_path = posixpath.dirname(opf_path)
-        guide_elem = opf_elem.find(OPF + 'guide')
+        for nav in nav_elem.iter(XHTML + 'nav'):
+            nav_types = nav.get(EPUB + 'type', '').split()
+            if 'page-list' not in nav_types and 'landmarks' not in nav_types:
+                continue
 
-        if guide_elem is not None:
-            for child in guide_elem:
-                if (not etree.iselement(child)
-                    and child.tag != OPF + 'reference'):
+            for link in nav.iter(XHTML + 'a'):
+                target = get_target(link.get('href'))
+                title = link.text_content().strip()
+                if target is None or not title:
                     continue
 
-                ref_type = child.get('type')
-                ref_title = child.get('title')
-                ref_inner_path = Soup.URI.decode(child.get('href'))
-                ref_href = posixpath.join(opf_dir_path, ref_inner_path)
-
-                guide.append((ref_href, ref_title, ref_type))
-
-        return guide
-
-    def _get_opf_landmarks(self, opf_elem):
-        # TODO: Implement landmarks
-        landmarks = []
-        if self.version == 3.0:
-            pass
+                if 'page-list' in nav_types:
+                    page_entries.append((title,) + target)
+                else:
+                    path, fragment = target
+                    href = path + '#' + fragment if fragment else path
+                    landmarks.append((href, title, link.get(EPUB + 'type')))
 
-        return landmarks
+        return PageList(page_entries), landmarks
 
     def _is_ops_document(self, mimetype):
         """
@@ -647,15 +1803,31 @@ class Epub(GObject.GObject):
         :param mimetype: A string containing the mimetype of the file
         :return: A lxml.etree._ElementTree object
         """
-        if mimetype == 'application/xhtml+xml':
-            parser = html.XHTMLParser(recover=True)
-        else:
-            parser = etree.XMLParser(recover=True)
-
+        parser = self._get_parser(mimetype)
         elem = html.fromstring(content_bytes, parser=parser).getroottree()
 
         return elem
 
+    def _get_parser(self, mimetype):
+        """
+        Get the parser of the current thread for the given mimetype
+
+        :param mimetype: A string containing the mimetype of the file
+        :return: A lxml.etree.XMLParser object
+        """
+        is_xhtml = mimetype == 'application/xhtml+xml'
+        name = 'xhtml' if is_xhtml else 'xml'
+        parser = getattr(THREAD_PARSERS, name, None)
+
+        if parser is None:
+            if is_xhtml:
+                parser = html.XHTMLParser(recover=True)
+            else:
+                parser = etree.XMLParser(recover=True)
+            setattr(THREAD_PARSERS, name, parser)
+
+        return parser
+
     def _elem_to_bytes(self, elem, mimetype):
         encoding = elem.docinfo.encoding
         standalone = elem.docinfo.standalone
@@ -672,9 +1844,8 @@ class Epub(GObject.GObject):
         fragment = ''
 
         if _path:
-            soup_uri = Soup.URI.new(_path)
-            path = soup_uri.get_path()[1:]
-            fragment = soup_uri.get_fragment() or ''
+            path, fragment = split_uri(_path)
+            fragment = fragment or ''
 
         return [path, fragment]
 
@@ -689,7 +1860,7 @@ class Epub(GObject.GObject):
             title = item.find('{D}navLabel/{D}text'.format(D=DAISY)).text
             _path = item.find('{0}content'.format(DAISY)).get('src', '')
             path, fragment = self._get_path_fragment(_path)
-            path = Soup.URI.decode(path)
+            path = decode_uri(path)
 
             children_list.append({'title': title,
                                   'path': path,
@@ -715,7 +1886,7 @@ class Epub(GObject.GObject):
             title = url.text_content()
             _path = url.get('href')
             path, fragment = self._get_path_fragment(_path)
-            path = Soup.URI.decode(path)
+            path = decode_uri(path)
 
             children_list.append({'title': title,
                                   'path': path,
@@ -737,64 +1908,277 @@ class Epub(GObject.GObject):
 
         return toc_list
 
-    def _replace_uris(self, resource_path, content_bytes, mimetype):
-        dirname = posixpath.dirname(resource_path)
-        elem = self._bytes_to_elem(content_bytes, mimetype)
+    def _read_media_overlay(self, path, smil_path):
+        """
+        Read the clips of a SMIL file that narrate a document
 
-        def set_epub_uri(tag, attr, ns):
-            if dirname:
-                path_base = 'epub:///{0}/'.format(dirname)
-            else:
-                path_base = 'epub:///'
+        The file is parsed incrementally, each par element is dropped as
+        soon as its clip is read.
 
-            soup_base = Soup.URI.new(path_base)
+        :param path: A path of a document
+        :param smil_path: The path of the SMIL file of the document
+        :return: A MediaOverlay object
+        """
+        # <par id="p1">
+        #   <text src="chapter1.xhtml#para1"/>
+        #   <audio src="audio/chapter1.mp3" clipBegin="0:00:01.200"
+        #          clipEnd="0:00:05.000"/>
+        # </par>
+        content = self.get_resource_content(smil_path)
+        clips = []
+
+        for event, par in etree.iterparse(io.BytesIO(content),
+                                          events=('end',),
+                                          tag=SMIL + 'par',
+                                          recover=True):
+            text_elem = par.find(SMIL + 'text')
+            audio_elem = par.find(SMIL + 'audio')
+            par.clear()
+
+            if text_elem is None or audio_elem is None:
+                continue
+
+            text_src = text_elem.get('src', '')
+            fragment = urllib.parse.urldefrag(text_src)[1]
+            if not fragment or resolve_href_path(smil_path,
+                                                 text_src) != path:
+                continue
 
-            if ns:
-                attrname = '{0}{1}'.format(ns, attr)
+            audio_src = audio_elem.get('src')
+            if not audio_src:
+                continue
+
+            audio_path = resolve_href_path(smil_path, audio_src)
+            if audio_path not in self.resources:
+                continue
+
+            try:
+                begin = get_clock_seconds(audio_elem.get('clipBegin', '0'))
+                end = audio_elem.get('clipEnd')
+                end = get_clock_seconds(end) if end else float('inf')
+            except ValueError:
+                continue
+
+            clips.append((fragment, audio_path, begin, end))
+
+        return MediaOverlay(clips)
+
+    def _get_document_text(self, path, content):
+        """
+        Extract the readable text of the content of a document
+
+        :param path: A path of a document
+        :param content: The content of the document
+        :return: The text of the body of the document
+        """
+        # Unlike _bytes_to_elem(), keep the body of documents that start
+        # with an XML declaration, which lxml.html turns into a div
+        parser = self._get_parser(self.get_resource_mime(path))
+        try:
+            root = etree.fromstring(content, parser=parser)
+        except etree.XMLSyntaxError:
+            root = None
+
+        if root is None:
+            return ''
+
+        body_texts = (self._get_elem_text(body)
+                      for body in root.xpath('//*[local-name() = "body"]'))
+
+        return '\n'.join(text for text in body_texts if text)
+
+    def _get_elem_text(self, elem):
+        """
+        Extract the readable text inside an element, one line per paragraph
+
+        :param elem: A lxml element
+        :return: A string
+        """
+        chunks = [WHITESPACE.sub(' ', elem.text or '')]
+        for child in elem:
+            chunks.extend(self._iter_elem_text(child))
+
+        lines = (WHITESPACE.sub(' ', line).strip()
+                 for line in ''.join(chunks).split('\n'))
+
+        return '\n'.join(line for line in lines if line)
+
+    def _get_block_elem(self, elem):
+        """
+        Get the closest block element containing an element, like the
+        paragraph of an anchor
+
+        :param elem: A lxml element
+        :return: A lxml element
+        """
+        block_elem = elem
+        while (etree.QName(block_elem).localname not in TEXT_BLOCK_TAGS
+               and block_elem.getparent() is not None
+               and etree.QName(block_elem.getparent()).localname != 'body'):
+            block_elem = block_elem.getparent()
+
+        return block_elem
+
+    def _iter_elem_text(self, elem):
+        """
+        Walk an element in document order, yielding its text and the text
+        that follows it. Block elements end with a line break.
+
+        :param elem: A lxml element
+        :return: A generator of strings
+        """
+        if isinstance(elem.tag, str):
+            tag = etree.QName(elem).localname
+            if tag not in TEXT_SKIPPED_TAGS:
+                if elem.text:
+                    yield WHITESPACE.sub(' ', elem.text)
+                for child in elem:
+                    yield from self._iter_elem_text(child)
+                if tag in TEXT_BLOCK_TAGS:
+                    yield '\n'
+
+        if elem.tail:
+            yield WHITESPACE.sub(' ', elem.tail)
+
+    def _get_direct_dependencies(self, path):
+        """
+        Find the resources referenced by a document or a stylesheet
+
+        :param path: A path of a resource
+        :return: A list with the paths of the resources in the book
+        """
+        mimetype = self.get_resource_mime(path)
+        hrefs = []
+
+        if mimetype == 'text/css':
+            css = self.get_resource_content(path).decode('utf-8', 'replace')
+            hrefs = self._get_css_hrefs(css)
+        elif self._is_ops_document(mimetype) or mimetype.endswith('xml'):
+            content = self.get_resource_content(path)
+            elem = self._bytes_to_elem(content, mimetype)
+
+            for tag, attr in DEPENDENCY_ATTRIBUTES:
+                for e in elem.iter('{*}' + tag):
+                    href = e.get(attr)
+                    if href:
+                        hrefs.append(href)
+
+            for tag, attr in SRCSET_ATTRIBUTES:
+                for e in elem.iter('{*}' + tag):
+                    srcset = e.get(attr)
+                    if srcset:
+                        hrefs.extend(self._get_srcset_hrefs(srcset))
+
+            for e in elem.iter('{*}style'):
+                if e.text:
+                    hrefs.extend(self._get_css_hrefs(e.text))
+
+            for e in elem.iter():
+                style = e.get('style') if isinstance(e.tag, str) else None
+                if style:
+                    hrefs.extend(self._get_css_hrefs(style))
+
+        dependencies = []
+        for href in hrefs:
+            href_path = resolve_href_path(path, href)
+            if href_path in self.resources and href_path != path:
+                dependencies.append(href_path)
+
+        return dependencies
+
+    def _get_css_hrefs(self, css):
+        """
+        Find the URLs in a stylesheet
+
+        :param css: The text of a stylesheet
+        :return: A list of strings
+        """
+        hrefs = [match.group(2) for match in CSS_IMPORT.finditer(css)]
+        hrefs.extend(match.group(2) for match in CSS_URL.finditer(css))
+
+        return hrefs
+
+    def _get_srcset_hrefs(self, srcset):
+        """
+        Find the URLs of the image candidates of a srcset attribute, like
+        "small.png 1x, large.png 2x"
+
+        :param srcset: The value of the attribute
+        :return: A list of strings
+        """
+        hrefs = []
+        position = 0
+
+        while True:
+            # Candidates are separated by commas and whitespace
+            while position < len(srcset) and (srcset[position] == ','
+                                              or srcset[position].isspace()):
+                position += 1
+            if position >= len(srcset):
+                break
+
+            start = position
+            while position < len(srcset) and not srcset[position].isspace():
+                position += 1
+            href = srcset[start:position]
+
+            if href.endswith(','):
+                # A candidate without descriptors
+                href = href.rstrip(',')
             else:
-                attrname = attr
-
-            tag_str = '{*}' + tag
-            elem_iter = elem.iter(tag_str)
-            for e in elem_iter:
-                # If element is inside <pre> tag, skip.
-                pre_ancestors = e.iterancestors('{*}pre')
-                has_pre = False
-                for pre_element in pre_ancestors:
-                    has_pre = True
-                    break
+                # Skip the descriptors, like "2x" or "480w"
+                comma = srcset.find(',', position)
+                position = comma if comma >= 0 else len(srcset)
 
-                if has_pre:
-                    continue
+            if href:
+                hrefs.append(href)
+
+        return hrefs
+
+    def _replace_uris(self, resource_path, content_bytes, mimetype):
+        """
+        Point the URIs of a document to the epub scheme, in a single walk
+        of the tree. Elements inside <pre> are left as they are.
 
-                attr_content = e.get(attrname)
-                if attr_content:
-                    if attr_content.startswith('#'):
-                        soup_base = Soup.URI.new('epub:///' + resource_path)
+        :param resource_path: The path of the document
+        :param content_bytes: The content of the document
+        :param mimetype: The mimetype of the document
+        :return: The rewritten content of the document
+        """
+        elem = self._bytes_to_elem(content_bytes, mimetype)
+        tags = ['{*}' + tag for tag in URI_ATTRIBUTES] + ['{*}pre']
+        # Elements inside <pre>, found when the <pre> element is reached
+        skipped = set()
 
-                    soup_uri = Soup.URI.new_with_base(soup_base, attr_content)
-                    uri = soup_uri.to_string(False)
-                    e.set(attrname, uri)
+        for e in elem.iter(*tags):
+            if e in skipped:
+                continue
 
-        set_epub_uri('link', 'href', None)
-        set_epub_uri('img', 'src', None)
-        set_epub_uri('image', 'href', XLINK)
-        set_epub_uri('a', 'href', None)
-        set_epub_uri('content', 'src', None)
+            local_name = e.tag.rpartition('}')[2]
+            if local_name == 'pre':
+                skipped.update(e.iter(*tags))
+                continue
+
+            attrname = URI_ATTRIBUTES[local_name]
+            attr_content = e.get(attrname)
+            if attr_content:
+                e.set(attrname, resolve_href(resource_path, attr_content))
 
         return self._elem_to_bytes(elem, mimetype)
 
-    def _calculate_pages_positions(self):
+    def _calculate_pages_positions(self, spine, resources):
         pages_sizes = []
         total_size = 0
         pages_positions = []
 
-        for page_path in self.spine_primary:
-            page_res = self.get_resource_content(page_path)
-            page_size = sys.getsizeof(page_res)
+        for page_path in spine:
+            page_size = resources[page_path].size
             total_size += page_size
             pages_sizes.append(page_size)
 
+        if not total_size:
+            return [0.0] * len(pages_sizes)
+
         accumulated_sizes = 0
         for page_size in pages_sizes:
             percent = accumulated_sizes / total_size * 100
@@ -0,0 +1,89 @@
+# export.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import sys
+
+from gettext import gettext as _
+
+from .book_error import BookError
+from .epub import Epub
+
+
+def export_text(epub_path: str, text_file) -> int:
+    """
+    Write the readable text of a book to a file, one document at a time,
+    so memory use does not grow with the size of the book
+
+    Documents are separated by a blank line.
+
+    :param epub_path: The path to the epub file or directory
+    :param text_file: A file object open for writing text
+    :return: The number of documents written
+    :raises BookError: When the file or format is incorrect.
+    """
+    epub = Epub()
+    epub.open(epub_path)
+    n_documents = 0
+
+    try:
+        for path, text in epub.iter_text():
+            if not text:
+                continue
+
+            if n_documents:
+                text_file.write('\n')
+            text_file.write(text)
+            text_file.write('\n')
+            n_documents += 1
+    finally:
+        epub.close()
+
+    return n_documents
+
+
+def main(args: list) -> int:
+    """
+    Run the export-text command
+
+    :param args: The command line arguments after the command name
+    :return: The exit status
+    """
+    arg_parser = argparse.ArgumentParser(
+        prog='seneca export-text',
+        description=_('Write the text of an epub file'))
+    arg_parser.add_argument('input', help=_('epub file or directory'))
+    arg_parser.add_argument('-o', '--output',
+                            help=_('text file to write, instead of the '
+                                   'standard output'))
+    options = arg_parser.parse_args(args)
+
+    try:
+        if options.output:
+            with open(options.output, 'w', encoding='utf-8') as text_file:
+                export_text(options.input, text_file)
+        else:
+            export_text(options.input, sys.stdout)
+    except BookError as e:
+        print('{0}: {1}'.format(e.args[2] or options.input, e.args[1]),
+              file=sys.stderr)
+        return 1
+    except OSError as e:
+        print('{0}: {1}'.format(options.output, e.strerror), file=sys.stderr)
+        return 1
+
+    return 0
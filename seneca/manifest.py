@@ -0,0 +1,320 @@
+# manifest.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import re
+import sys
+
+ROMAN_NUMERAL = re.compile(r'^[ivxlcdm]+$', re.IGNORECASE)
+ROMAN_VALUES = {'i': 1, 'v': 5, 'x': 10, 'l': 50, 'c': 100, 'd': 500,
+                'm': 1000}
+# SMIL clock values: full and partial clock values, or timecounts
+CLOCK_VALUE = re.compile(r'^(?:(\d+):)?(\d+):(\d+(?:\.\d*)?)$')
+TIMECOUNT_VALUE = re.compile(r'^(\d+(?:\.\d*)?)(h|min|s|ms)?$')
+TIMECOUNT_SECONDS = {'h': 3600, 'min': 60, 's': 1, 'ms': 0.001, None: 1}
+
+
+class ManifestItem:
+    """A resource listed in the OPF manifest"""
+
+    __slots__ = ('id', 'mimetype', 'properties', 'size', 'media_overlay')
+
+    def __init__(self, res_id, mimetype, properties=(), size=0,
+                 media_overlay=''):
+        """
+        Initialize ManifestItem class
+
+        Identifiers, mime types and properties repeat a lot across a
+        manifest, so they are interned.
+
+        :param res_id: The id of the resource
+        :param mimetype: The media type of the resource
+        :param properties: An iterable with the properties of the resource
+        :param size: The uncompressed size of the resource
+        :param media_overlay: The id of the SMIL file of the resource
+        """
+        self.id = sys.intern(res_id or '')
+        self.mimetype = sys.intern(mimetype or '')
+        self.properties = tuple(sys.intern(prop) for prop in properties)
+        self.size = size
+        self.media_overlay = sys.intern(media_overlay or '')
+
+    def to_list(self) -> list:
+        """
+        Get the serializable fields of the item
+
+        :return: A list that can be given back to from_list()
+        """
+        return [self.id, self.mimetype, list(self.properties), self.size,
+                self.media_overlay]
+
+    @classmethod
+    def from_list(cls, fields):
+        return cls(*fields)
+
+
+class Spine:
+    """An ordered list of resource paths with constant time lookups"""
+
+    __slots__ = ('_paths', '_indexes')
+
+    def __init__(self, paths=()):
+        """
+        Initialize Spine class
+
+        :param paths: An iterable with the paths of the spine, in order
+        """
+        self._paths = tuple(sys.intern(path) for path in paths)
+        self._indexes = {}
+
+        # Keep the first position of repeated paths, like list.index()
+        for i, path in enumerate(self._paths):
+            self._indexes.setdefault(path, i)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __getitem__(self, i):
+        return self._paths[i]
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __contains__(self, path):
+        return path in self._indexes
+
+    def __eq__(self, other):
+        if isinstance(other, Spine):
+            return self._paths == other._paths
+
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Spine({0!r})'.format(list(self._paths))
+
+    def index(self, path) -> int:
+        """
+        Get the position of a path in the spine
+
+        :param path: A resource path
+        :return: The position of the path
+        :raises ValueError: When the path is not in the spine
+        """
+        try:
+            return self._indexes[path]
+        except KeyError:
+            raise ValueError(path) from None
+
+    def to_list(self) -> list:
+        return list(self._paths)
+
+
+class PageList:
+    """The printed page labels of a book and where they are, sorted by
+    label for binary searches"""
+
+    __slots__ = ('_entries', '_keys', '_order')
+
+    def __init__(self, entries=()):
+        """
+        Initialize PageList class
+
+        :param entries: An iterable with (label, path, fragment) tuples, in
+            reading order
+        """
+        self._entries = tuple((label, sys.intern(path), fragment)
+                              for label, path, fragment in entries)
+
+        # Labels may repeat, keep the first one like Spine does
+        keys = {}
+        for i, (label, path, fragment) in enumerate(self._entries):
+            keys.setdefault(get_label_key(label), i)
+
+        sorted_keys = sorted(keys)
+        self._keys = tuple(sorted_keys)
+        self._order = tuple(keys[key] for key in sorted_keys)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __eq__(self, other):
+        if isinstance(other, PageList):
+            return self._entries == other._entries
+
+        return NotImplemented
+
+    def __repr__(self):
+        return 'PageList({0!r})'.format(list(self._entries))
+
+    def find(self, label: str, nearest: bool = False):
+        """
+        Find where a printed page starts
+
+        :param label: A page label, like '347' or 'xiv'
+        :param nearest: Whether to fall back to the closest previous page
+            when a numbered page is not listed
+        :return: A (path, fragment) tuple or None
+        """
+        key = get_label_key(label)
+        i = bisect.bisect_left(self._keys, key)
+
+        if i < len(self._keys) and self._keys[i] == key:
+            entry = self._entries[self._order[i]]
+        elif (nearest and i > 0 and key[0] < 2
+                and self._keys[i - 1][0] == key[0]):
+            entry = self._entries[self._order[i - 1]]
+        else:
+            return None
+
+        return entry[1], entry[2]
+
+    def to_list(self) -> list:
+        return [list(entry) for entry in self._entries]
+
+
+class MediaOverlay:
+    """The clips of audio narrating the elements of a document, sorted by
+    element and by time for binary searches"""
+
+    __slots__ = ('_clips', '_positions', '_times', '_order')
+
+    def __init__(self, clips=()):
+        """
+        Initialize MediaOverlay class
+
+        :param clips: An iterable with (fragment, audio path, begin, end)
+            tuples in playback order, times in seconds
+        """
+        self._clips = tuple((fragment, sys.intern(audio_path), begin, end)
+                            for fragment, audio_path, begin, end in clips)
+
+        # Keep the first clip of repeated fragments, like Spine does
+        self._positions = {}
+        for i, clip in enumerate(self._clips):
+            self._positions.setdefault(clip[0], i)
+
+        times = sorted((clip[1], clip[2], i)
+                       for i, clip in enumerate(self._clips))
+        self._times = tuple((audio_path, begin)
+                            for audio_path, begin, i in times)
+        self._order = tuple(i for audio_path, begin, i in times)
+
+    def __len__(self):
+        return len(self._clips)
+
+    def __getitem__(self, i):
+        return self._clips[i]
+
+    def __iter__(self):
+        return iter(self._clips)
+
+    def __eq__(self, other):
+        if isinstance(other, MediaOverlay):
+            return self._clips == other._clips
+
+        return NotImplemented
+
+    def __repr__(self):
+        return 'MediaOverlay({0!r})'.format(list(self._clips))
+
+    def index(self, fragment) -> int:
+        """
+        Get the position of the clip narrating an element
+
+        :param fragment: The id of the element
+        :return: The position of the clip in playback order
+        :raises ValueError: When the element is not narrated
+        """
+        try:
+            return self._positions[fragment]
+        except KeyError:
+            raise ValueError(fragment) from None
+
+    def find(self, audio_path: str, time: float):
+        """
+        Find the clip playing at a time of an audio file
+
+        :param audio_path: The path of the audio file
+        :param time: The position in the audio file, in seconds
+        :return: The position of the clip in playback order or None
+        """
+        i = bisect.bisect_right(self._times, (audio_path, time)) - 1
+        if i < 0 or self._times[i][0] != audio_path:
+            return None
+
+        position = self._order[i]
+        if time >= self._clips[position][3]:
+            return None
+
+        return position
+
+    def to_list(self) -> list:
+        return [list(clip) for clip in self._clips]
+
+
+def get_clock_seconds(value: str) -> float:
+    """
+    Convert a SMIL clock value, like '0:01:02.5', '62.5s' or '500ms', to
+    seconds
+
+    :param value: A clock value
+    :return: The number of seconds
+    :raises ValueError: When the value is not a clock value
+    """
+    value = value.strip()
+
+    match = CLOCK_VALUE.match(value)
+    if match:
+        hours, minutes, seconds = match.groups()
+        return int(hours or 0) * 3600 + int(minutes) * 60 + float(seconds)
+
+    match = TIMECOUNT_VALUE.match(value)
+    if match:
+        return float(match.group(1)) * TIMECOUNT_SECONDS[match.group(2)]
+
+    raise ValueError(value)
+
+
+def get_label_key(label: str) -> tuple:
+    """
+    Get a sort key for a page label: arabic numbers first, by value, then
+    roman numbers, by value, then everything else, alphabetically
+
+    :param label: A page label
+    :return: A tuple
+    """
+    label = label.strip().casefold()
+
+    if label.isdecimal():
+        return 0, int(label), ''
+
+    if ROMAN_NUMERAL.match(label):
+        value = 0
+        for i, char in enumerate(label):
+            char_value = ROMAN_VALUES[char]
+            if (i + 1 < len(label)
+                    and ROMAN_VALUES[label[i + 1]] > char_value):
+                value -= char_value
+            else:
+                value += char_value
+
+        return 1, value, ''
+
+    return 2, 0, label
@@ -0,0 +1,430 @@
+# repack.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import collections
+import os
+import posixpath
+import sys
+import time
+import urllib.parse
+import zipfile
+import zlib
+
+from gettext import gettext as _
+from lxml import etree
+
+from .book_error import BookError
+from .container import DirectoryContainer, ZipContainer
+from .epub import ARCHIVE_ERRORS, OPF, Epub
+from .resource_cache import ResourceCache
+
+DEFAULT_LEVEL = 9
+# Members that deflate to more than this fraction of their size are stored
+STORE_RATIO = 0.9
+# Bytes of a member deflated to decide whether to store it
+DEFLATE_SAMPLE_SIZE = 64 * 1024
+OPEN_RUNS = 3
+# Members inflated at a time while copying them
+REPACK_BATCH_SIZE = 32
+
+RepackReport = collections.namedtuple('RepackReport', ['input_size',
+                                                       'output_size',
+                                                       'dropped',
+                                                       'stored',
+                                                       'input_open_time',
+                                                       'output_open_time'])
+
+
+def find_reachable(epub: Epub, opf_elem) -> set:
+    """
+    Find the resources of a book that a reader can get to: the spine, the
+    table of contents, the guide and the cover, and everything they depend
+    on or link to, including manifest fallbacks and media overlays
+
+    :param epub: An opened Epub object
+    :param opf_elem: The root element of the OPF file of the book
+    :return: A set with the paths of the reachable resources
+    """
+    manifest_refs = {}
+
+    for item in opf_elem.iterfind('{0}manifest/{0}item'.format(OPF)):
+        refs = [item.get(attr) for attr in ('fallback', 'media-overlay')]
+        manifest_refs[item.get('id')] = [ref for ref in refs if ref]
+
+    pending = list(epub.spine_primary) + list(epub.spine_auxiliary)
+    pending.append(epub.toc_path)
+    pending.extend(urllib.parse.urldefrag(href)[0]
+                   for href, title, ref_type in epub.guide)
+    pending.extend(epub.resources_by_id.get(meta.get('content'))
+                   for meta in opf_elem.iterfind(
+                       '{0}metadata/{0}meta[@name="cover"]'.format(OPF)))
+    pending.extend(path for path, resource in epub.resources.items()
+                   if {'nav', 'cover-image'} & set(resource.properties))
+
+    reachable = set()
+
+    while pending:
+        path = pending.pop()
+        if path in reachable or path not in epub.resources:
+            continue
+
+        reachable.add(path)
+        pending.extend(epub.get_dependencies(path))
+        pending.extend(epub.get_links(path))
+
+        for ref in manifest_refs.get(epub.resources[path].id, ()):
+            pending.append(epub.resources_by_id.get(ref))
+
+    return reachable
+
+
+def find_mentioned(epub: Epub, paths: set) -> set:
+    """
+    Find the resources whose file name appears anywhere in the documents,
+    stylesheets and other text resources of a book. A resource that is
+    not mentioned can not be referenced in a way find_reachable() missed.
+
+    :param epub: An opened Epub object
+    :param paths: A set with the paths of the resources to look for
+    :return: A set with the paths of the mentioned resources
+    """
+    names = {}
+    for path in paths:
+        name = posixpath.basename(path)
+        names[path] = {name.encode('utf-8'),
+                       urllib.parse.quote(name).encode('ascii')}
+
+    mentioned = set()
+
+    for path, resource in epub.resources.items():
+        if not names or not _is_text_resource(resource.mimetype):
+            continue
+
+        content = epub.get_resource_content(path)
+        for name_path, variants in list(names.items()):
+            if any(variant in content for variant in variants):
+                mentioned.add(name_path)
+                del names[name_path]
+
+    return mentioned
+
+
+def remove_manifest_items(opf_path: str, opf_elem, paths: set) -> int:
+    """
+    Remove the manifest entries of the given resources from an OPF file
+
+    :param opf_path: The path of the OPF file inside the book
+    :param opf_elem: The root element of the OPF file, modified in place
+    :param paths: A set with the paths of the resources to remove
+    :return: The number of removed entries
+    """
+    opf_dir_path = posixpath.dirname(opf_path)
+    manifest_elem = opf_elem.find(OPF + 'manifest')
+    removed = 0
+
+    for item in list(manifest_elem.iterfind(OPF + 'item')):
+        href = urllib.parse.unquote(item.get('href', ''))
+        if posixpath.join(opf_dir_path, href) in paths:
+            manifest_elem.remove(item)
+            removed += 1
+
+    return removed
+
+
+def repack(epub_path: str, output_path: str,
+           level: int = DEFAULT_LEVEL,
+           keep_unreferenced: bool = False) -> RepackReport:
+    """
+    Write an optimized copy of an epub file or unpacked epub directory
+
+    Members outside the manifest are dropped, and so are the manifest
+    resources no reader can get to, unless keep_unreferenced is set.
+    Images, fonts, audio and video are kept as long as their file name
+    appears in a text resource of the book, in case a reference was not
+    followed. The mimetype member is stored first, the other members are
+    deflated when it pays off and stored otherwise, so they can be served
+    without being inflated.
+
+    :param epub_path: The path to the epub file or directory
+    :param output_path: The path of the epub file to write
+    :param level: The zlib compression level, from 0 to 9
+    :param keep_unreferenced: Whether to keep every manifest resource
+    :return: A RepackReport record
+    :raises BookError: When the book can not be read or written
+    """
+    epub = Epub()
+    epub.index_cache = None
+    epub.dependency_cache = None
+    epub.notes_cache = None
+    epub.open(epub_path)
+
+    try:
+        container = _open_container(epub_path)
+    except ARCHIVE_ERRORS as e:
+        epub.close()
+        raise BookError(0, _('Could not read zip format'), epub_path) from e
+
+    tmp_path = output_path + '.tmp'
+
+    try:
+        opf_content = container.read(epub.opf_path)
+        parser = etree.XMLParser(recover=True)
+        opf_tree = etree.fromstring(opf_content, parser=parser).getroottree()
+        opf_elem = opf_tree.getroot()
+
+        if keep_unreferenced:
+            kept = set(epub.resources)
+        else:
+            kept = find_reachable(epub, opf_elem)
+            # Images, fonts and media are only dropped when nothing in the
+            # book mentions them
+            kept |= find_mentioned(epub, {
+                path for path, resource in epub.resources.items()
+                if path not in kept and _is_passive_resource(
+                    resource.mimetype)})
+
+        unreferenced = set(epub.resources) - kept
+        if unreferenced:
+            remove_manifest_items(epub.opf_path, opf_elem, unreferenced)
+            opf_content = etree.tostring(
+                opf_tree,
+                xml_declaration=True,
+                encoding=opf_tree.docinfo.encoding or 'utf-8',
+                standalone=opf_tree.docinfo.standalone)
+
+        names = [name for name in container.namelist()
+                 if not name.endswith('/')]
+        names = _get_member_order(names, epub.opf_path)
+        dropped = [name for name in names
+                   if name not in kept and not _is_package_member(
+                       name, epub.opf_path)]
+        names = [name for name in names if name not in dropped]
+
+        stored = 0
+
+        with zipfile.ZipFile(tmp_path, 'w') as output_zip:
+            for i in range(0, len(names), REPACK_BATCH_SIZE):
+                batch = names[i:i + REPACK_BATCH_SIZE]
+                contents = container.read_many(
+                    name for name in batch if name != epub.opf_path)
+                contents[epub.opf_path] = opf_content
+
+                for name in batch:
+                    content = contents.pop(name)
+                    info = container.getinfo(name)
+                    new_info = zipfile.ZipInfo(name, info.date_time)
+                    new_info.external_attr = info.external_attr
+
+                    if name == 'mimetype' or not _is_worth_deflating(
+                            content, level):
+                        new_info.compress_type = zipfile.ZIP_STORED
+                        stored += 1
+                    else:
+                        new_info.compress_type = zipfile.ZIP_DEFLATED
+
+                    output_zip.writestr(new_info, content,
+                                        compresslevel=level)
+
+        os.replace(tmp_path, output_path)
+    except OSError as e:
+        raise BookError(1, _('Could not write file'), output_path) from e
+    except ARCHIVE_ERRORS as e:
+        raise BookError(0, _('Could not read zip format'), epub_path) from e
+    finally:
+        container.close()
+        epub.close()
+        _remove_file(tmp_path)
+
+    return RepackReport(input_size=_get_size(epub_path),
+                        output_size=os.path.getsize(output_path),
+                        dropped=dropped,
+                        stored=stored,
+                        input_open_time=measure_open_time(epub_path),
+                        output_open_time=measure_open_time(output_path))
+
+
+def measure_open_time(epub_path: str) -> float:
+    """
+    Measure how long it takes to open a book without any cache and read
+    every document of its spine
+
+    :param epub_path: The path to the epub file or directory
+    :return: The best time of a few runs, in seconds
+    """
+    times = []
+
+    for i in range(OPEN_RUNS):
+        epub = Epub()
+        epub.index_cache = None
+        epub.dependency_cache = None
+        epub.notes_cache = None
+        epub.resource_cache = ResourceCache(0)
+
+        start = time.perf_counter()
+        epub.open(epub_path)
+        for path in epub.spine_primary:
+            epub.get_resource_content(path)
+        times.append(time.perf_counter() - start)
+
+        epub.close()
+
+    return min(times)
+
+
+def main(args: list) -> int:
+    """
+    Run the optimize command
+
+    :param args: The command line arguments after the command name
+    :return: The exit status
+    """
+    arg_parser = argparse.ArgumentParser(
+        prog='seneca optimize',
+        description=_('Write an optimized copy of an epub file'))
+    arg_parser.add_argument('input', help=_('epub file or directory'))
+    arg_parser.add_argument('output', help=_('epub file to write'))
+    arg_parser.add_argument('-l', '--level', type=int,
+                            choices=range(0, 10), default=DEFAULT_LEVEL,
+                            metavar='0-9',
+                            help=_('compression level'))
+    arg_parser.add_argument('-k', '--keep-unreferenced', action='store_true',
+                            help=_('keep every resource of the manifest'))
+    options = arg_parser.parse_args(args)
+
+    if (os.path.abspath(options.input)
+            == os.path.abspath(options.output)):
+        print(_('The output file must be different from the input'),
+              file=sys.stderr)
+        return 1
+
+    try:
+        report = repack(options.input, options.output,
+                        options.level, options.keep_unreferenced)
+    except BookError as e:
+        print('{0}: {1}'.format(e.args[2] or options.input, e.args[1]),
+              file=sys.stderr)
+        return 1
+
+    for name in report.dropped:
+        print(_('Dropped {0}').format(name))
+
+    print(_('Size: {0} → {1} bytes ({2:+.1%})').format(
+        report.input_size,
+        report.output_size,
+        _get_change(report.input_size, report.output_size)))
+    print(_('Open time: {0:.1f} → {1:.1f} ms ({2:+.1%})').format(
+        report.input_open_time * 1000,
+        report.output_open_time * 1000,
+        _get_change(report.input_open_time, report.output_open_time)))
+
+    return 0
+
+
+def _open_container(path):
+    if os.path.isdir(path):
+        return DirectoryContainer(path)
+
+    return ZipContainer(path)
+
+
+def _is_passive_resource(mimetype):
+    return (mimetype.startswith(('image/', 'audio/', 'video/', 'font/'))
+            or 'font' in mimetype
+            or mimetype == 'application/vnd.ms-opentype')
+
+
+def _is_text_resource(mimetype):
+    return (mimetype.startswith('text/')
+            or mimetype.endswith(('xml', 'json', 'javascript')))
+
+
+def _is_package_member(name, opf_path):
+    """
+    Check if a member belongs to the container rather than the manifest
+
+    :param name: The path of the member
+    :param opf_path: The path of the OPF file
+    :return: True for the mimetype, META-INF and OPF files
+    """
+    return (name in ('mimetype', opf_path)
+            or (name.startswith('META-INF/') and not name.endswith('/')))
+
+
+def _get_member_order(names, opf_path):
+    """
+    Sort members the way readers look for them: the mimetype, the
+    container files and the OPF file first, the rest as they were
+
+    :param names: A list with the paths of the members
+    :param opf_path: The path of the OPF file
+    :return: A list with the same paths
+    """
+    def get_rank(name):
+        if name == 'mimetype':
+            return 0
+        if name.startswith('META-INF/'):
+            return 1
+        if name == opf_path:
+            return 2
+        return 3
+
+    return sorted(names, key=get_rank)
+
+
+def _is_worth_deflating(content, level):
+    """
+    Guess whether deflating a member saves enough space, by deflating a
+    sample of it as fast as possible, so most of the member is deflated
+    only once, when it is written
+
+    :param content: The content of the member
+    :param level: The zlib compression level the member would be written
+        with
+    :return: True when the member should be deflated
+    """
+    if not content or not level:
+        return False
+
+    sample = content[:DEFLATE_SAMPLE_SIZE]
+    compressor = zlib.compressobj(1, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated_size = len(compressor.compress(sample) + compressor.flush())
+
+    return deflated_size <= len(sample) * STORE_RATIO
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _get_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, dirnames, filenames in os.walk(path)
+               for filename in filenames)
+
+
+def _get_change(old, new):
+    if not old:
+        return 0.0
+
+    return (new - old) / old
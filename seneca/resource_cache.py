@@ -0,0 +1,157 @@
+# resource_cache.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import threading
+
+DEFAULT_BUDGET = 64 * 1024 * 1024
+
+
+class ResourceCache:
+    """A least recently used cache of decompressed resources, or of any
+    other bytes, bounded by the total size of its content"""
+
+    __default = None
+
+    def __init__(self, budget: int = DEFAULT_BUDGET) -> None:
+        """
+        Initialize ResourceCache class
+
+        :param budget: The maximum number of bytes to keep
+        """
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_default(cls):
+        """
+        Get the cache shared by every book of the application
+
+        :return: A ResourceCache object
+        """
+        if cls.__default is None:
+            cls.__default = cls()
+
+        return cls.__default
+
+    def get(self, key):
+        """
+        Get an item and mark it as the most recently used
+
+        :param key: The key of the item
+        :return: The content of the item or None when it is not cached
+        """
+        with self._lock:
+            content = self._items.get(key)
+            if content is None:
+                self.misses += 1
+                return None
+
+            self._items.move_to_end(key)
+            self.hits += 1
+
+            return content
+
+    def put(self, key, content) -> None:
+        """
+        Add an item, evicting the least recently used ones to stay within
+        the budget. Items bigger than the whole budget are not kept.
+
+        :param key: The key of the item
+        :param content: A bytes-like object
+        """
+        content_size = len(content)
+        if content_size > self.budget:
+            return
+
+        with self._lock:
+            old_content = self._items.pop(key, None)
+            if old_content is not None:
+                self.size -= len(old_content)
+
+            self._items[key] = content
+            self.size += content_size
+            self._evict()
+
+    def remove(self, key) -> None:
+        with self._lock:
+            content = self._items.pop(key, None)
+            if content is not None:
+                self.size -= len(content)
+
+    def rename(self, key_map: dict) -> None:
+        """
+        Give cached items new keys, without counting them as used and
+        keeping their place in the least recently used order
+
+        :param key_map: A dictionary of new keys by current key
+        """
+        with self._lock:
+            items = collections.OrderedDict()
+
+            for key, content in self._items.items():
+                new_key = key_map.get(key, key)
+                if new_key in items or (new_key != key
+                                        and new_key in self._items):
+                    # Already cached under the new key
+                    self.size -= len(content)
+                    continue
+
+                items[new_key] = content
+
+            self._items = items
+
+    def set_budget(self, budget: int) -> None:
+        with self._lock:
+            self.budget = budget
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def get_stats(self) -> dict:
+        """
+        Get the usage counters of the cache
+
+        :return: A dictionary with the hits, misses, the fraction of
+            lookups that were hits, evictions, the number of items and
+            their size
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions,
+                    'items': len(self._items),
+                    'size': self.size,
+                    'budget': self.budget}
+
+    def _evict(self):
+        while self.size > self.budget and self._items:
+            key, content = self._items.popitem(last=False)
+            self.size -= len(content)
+            self.evictions += 1
@@ -35,7 +35,10 @@ class Settings:
                         'fontstretch': 'normal',
                         'fontsize': '20',
                         'lineheight': '1.6',
+                        'cachesize': '64',
                         'paginate': 'yes',
+                        'keepcompressed': 'no',
+                        'loadbyuri': 'no',
                         'maximized': 'no',
                         'height': '600',
                         'width': '800'}
@@ -173,6 +176,15 @@ class Settings:
     def lineheight(self, value):
         self.conf['Settings']['lineheight'] = str(value)
 
+    @property
+    def cachesize(self):
+        """Budget in MiB of the cache of decompressed book resources"""
+        return int(self.conf['Settings']['cachesize'])
+
+    @cachesize.setter
+    def cachesize(self, value):
+        self.conf['Settings']['cachesize'] = str(value)
+
     @property
     def paginate(self):
         return self.conf['Settings'].getboolean('paginate')
@@ -182,6 +194,24 @@ class Settings:
         value = 'yes' if value else 'no'
         self.conf['Settings']['paginate'] = value
 
+    @property
+    def keepcompressed(self):
+        return self.conf['Settings'].getboolean('keepcompressed')
+
+    @keepcompressed.setter
+    def keepcompressed(self, value):
+        value = 'yes' if value else 'no'
+        self.conf['Settings']['keepcompressed'] = value
+
+    @property
+    def loadbyuri(self):
+        return self.conf['Settings'].getboolean('loadbyuri')
+
+    @loadbyuri.setter
+    def loadbyuri(self, value):
+        value = 'yes' if value else 'no'
+        self.conf['Settings']['loadbyuri'] = value
+
     @property
     def maximized(self):
         return self.conf['Settings'].getboolean('maximized')
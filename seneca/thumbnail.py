@@ -0,0 +1,206 @@
+# thumbnail.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import logging
+import os
+import gi
+
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf, Gio, GLib
+from gettext import gettext as _
+
+from .book_error import BookError
+from .cache import get_cache_dir
+from .epub import ARCHIVE_ERRORS, Epub
+
+logger = logging.getLogger(__name__)
+
+# The largest width or height of a thumbnail, like freedesktop.org large
+# thumbnails
+THUMBNAIL_SIZE = 256
+# Covers decoded at the same time
+THUMBNAIL_WORKERS = 2
+
+
+class ThumbnailCache:
+    # Increase when the way thumbnails are made changes
+    VERSION = 1
+
+    def __init__(self, size: int = THUMBNAIL_SIZE) -> None:
+        """
+        Initialize ThumbnailCache class
+
+        Thumbnails are PNG files named after the identity of the book, so
+        they are found again without opening the book.
+
+        :param size: The largest width or height of a thumbnail
+        """
+        self.path = get_cache_dir('thumbnails')
+        self.size = size
+        self._executor = None
+
+    def get_thumbnail(self, epub_path: str):
+        """
+        Get the thumbnail of the cover of a book, making it when needed
+
+        :param epub_path: The path to the epub file or directory
+        :return: The path to a PNG file, or None when the book has no
+            usable cover
+        :raises BookError: When the file or format is incorrect.
+        """
+        identity = Epub().read_identity(epub_path)
+        cache_path = self._get_cache_path(identity)
+
+        if os.path.exists(cache_path):
+            return cache_path
+
+        # Books without a cover are remembered too
+        if os.path.exists(cache_path + '.none'):
+            return None
+
+        return self._make_thumbnail(epub_path, cache_path)
+
+    def get_thumbnail_async(self, epub_path: str,
+                            cancellable: Gio.Cancellable,
+                            callback: object,
+                            *user_data):
+        """
+        Get the thumbnail of the cover of a book without blocking
+
+        Covers are decoded and scaled by a few worker threads, so many
+        thumbnails can be requested at once. When done, callback is called
+        on the main loop as callback(thumbnail_cache, result, *user_data)
+        and it must call get_thumbnail_finish(result).
+
+        :param epub_path: The path to the epub file or directory
+        :param cancellable: A Gio.Cancellable object or None
+        :param callback: The function to call when the operation is done
+        :param user_data: Extra arguments for callback
+        """
+        def load():
+            result = {'path': epub_path,
+                      'cancellable': cancellable,
+                      'thumbnail': None,
+                      'error': None}
+            try:
+                if cancellable is not None:
+                    cancellable.set_error_if_cancelled()
+                result['thumbnail'] = self.get_thumbnail(epub_path)
+            except (BookError, GLib.Error) as e:
+                result['error'] = e
+            except ARCHIVE_ERRORS as e:
+                result['error'] = BookError(0, _('Could not read zip format'),
+                                            epub_path)
+                result['error'].__cause__ = e
+            except Exception as e:
+                # The executor would keep the exception and never call back
+                logger.error('Could not make thumbnail:' + str(e))
+                result['error'] = BookError(0, _('Unrecognized file format'),
+                                            epub_path)
+                result['error'].__cause__ = e
+
+            GLib.idle_add(callback, self, result, *user_data)
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=THUMBNAIL_WORKERS)
+
+        self._executor.submit(load)
+
+    def get_thumbnail_finish(self, result: dict):
+        """
+        Finish an operation started with get_thumbnail_async()
+
+        :param result: The result given to the callback
+        :return: The path to a PNG file or None
+        :raises BookError: When the file or format is incorrect.
+        :raises GLib.Error: When the operation was cancelled.
+        """
+        if result['error'] is not None:
+            raise result['error']
+
+        if result['cancellable'] is not None:
+            result['cancellable'].set_error_if_cancelled()
+
+        return result['thumbnail']
+
+    def _make_thumbnail(self, epub_path, cache_path):
+        """
+        Decode the cover of a book at thumbnail size and store it
+
+        :param epub_path: The path to the epub file or directory
+        :param cache_path: The path of the PNG file to write
+        :return: cache_path, or None when the book has no usable cover
+        :raises BookError: When the file or format is incorrect.
+        """
+        metadata = Epub().read_metadata(epub_path, with_cover=True)
+        pixbuf = None
+
+        if metadata.cover:
+            try:
+                pixbuf = self._decode(metadata.cover)
+            except GLib.Error as e:
+                logger.info('Could not decode cover:' + str(e))
+
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+
+            if pixbuf is None:
+                open(cache_path + '.none', 'wb').close()
+                return None
+
+            tmp_path = cache_path + '.tmp'
+            pixbuf.savev(tmp_path, 'png', [], [])
+            os.replace(tmp_path, cache_path)
+        except (OSError, GLib.Error) as e:
+            logger.warning('Could not save thumbnail:' + str(e))
+            return None
+
+        return cache_path
+
+    def _decode(self, content):
+        """
+        Decode an image scaled down to fit the thumbnail size
+
+        The size is set before decoding, so loaders like the JPEG one can
+        skip most of the work for big covers.
+
+        :param content: The bytes of the image
+        :return: A GdkPixbuf.Pixbuf object
+        :raises GLib.Error: When the image can not be decoded
+        """
+        def on_size_prepared(loader, width, height):
+            scale = min(self.size / width, self.size / height, 1.0)
+            loader.set_size(max(int(width * scale), 1),
+                            max(int(height * scale), 1))
+
+        loader = GdkPixbuf.PixbufLoader()
+        loader.connect('size-prepared', on_size_prepared)
+
+        try:
+            loader.write(content)
+        finally:
+            loader.close()
+
+        return loader.get_pixbuf()
+
+    def _get_cache_path(self, identity):
+        name = '{0}-{1}-{2}.png'.format(identity, self.size, self.VERSION)
+
+        return os.path.join(self.path, name)
@@ -0,0 +1,294 @@
+# uri.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Resolve and split epub:/// URIs the way Soup.URI does, without calling
+# into libsoup for every link of a document. URIs with another scheme or
+# with a host are still handled by Soup.URI.
+
+import functools
+import posixpath
+import re
+import urllib.parse
+import gi
+
+gi.require_version('Soup', '2.4')
+from gi.repository import Soup
+
+EPUB_PREFIX = 'epub:///'
+# Resolved references kept, by base URI and reference
+RESOLVE_CACHE_SIZE = 4096
+
+WHITESPACE = ' \t\n\v\f\r'
+SCHEME = re.compile(r'[A-Za-z][A-Za-z0-9.+-]*:')
+# Parts that Soup.URI keeps as they are: printable ASCII without '%'
+NORMALIZED = re.compile(r'[!-$&-~]*\Z')
+UNRESERVED = frozenset(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                       b'abcdefghijklmnopqrstuvwxyz'
+                       b'0123456789-._~')
+HEX_DIGITS = frozenset(b'0123456789ABCDEFabcdef')
+
+
+def resolve_href(document_path: str, href: str) -> str:
+    """
+    Resolve a reference found in a document of the book to an absolute
+    URI, like Soup.URI.new_with_base() does with the epub:/// URI of the
+    document directory, or of the document itself for fragments
+
+    :param document_path: The path of the document inside the book
+    :param href: The value of an attribute like href or src
+    :return: An epub:/// URI, or the reference as an absolute URI when it
+        has a scheme
+    """
+    if href.startswith('#'):
+        return _resolve(EPUB_PREFIX + document_path, href)
+
+    dirname = posixpath.dirname(document_path)
+    if dirname:
+        return _resolve(EPUB_PREFIX + dirname + '/', href)
+
+    return _resolve(EPUB_PREFIX, href)
+
+
+def resolve_href_path(document_path: str, href: str):
+    """
+    Get the path inside the book of the resource a reference found in a
+    document points to, resolved like resolve_href() does
+
+    :param document_path: The path of the document inside the book
+    :param href: The value of an attribute like href or src
+    :return: The decoded path, or None when the reference points outside
+        the book
+    """
+    uri = resolve_href(document_path, href)
+    if not uri.startswith(EPUB_PREFIX):
+        return None
+
+    return decode_uri(split_uri(uri)[0])
+
+
+def get_epub_uri(path: str) -> str:
+    """
+    Make the epub:/// URI of a resource of the book
+
+    :param path: The path of the resource inside the book
+    :return: An epub:/// URI, which split_uri() and decode_uri() turn
+        back into the path
+    """
+    return EPUB_PREFIX + urllib.parse.quote(path)
+
+
+def split_uri(uri: str) -> tuple:
+    """
+    Get the path and the fragment of a URI, like Soup.URI.get_path() and
+    Soup.URI.get_fragment() do
+
+    :param uri: An absolute URI, like the ones made by resolve_href()
+    :return: A tuple with the path without its leading slash, still
+        percent-encoded, and the fragment or None
+    """
+    return _split(uri)
+
+
+def decode_uri(value: str) -> str:
+    """
+    Decode the percent-encoded characters of a URI or part of a URI, like
+    Soup.URI.decode() does
+
+    :param value: A percent-encoded string
+    :return: The decoded string
+    """
+    return urllib.parse.unquote(value)
+
+
+@functools.lru_cache(maxsize=RESOLVE_CACHE_SIZE)
+def _resolve(base, href):
+    """
+    Resolve a reference against an epub:/// URI without a host
+
+    :param base: An epub:/// URI
+    :param href: A URI reference
+    :return: The resolved URI as a string
+    """
+    reference = _clean(href)
+
+    if SCHEME.match(reference) or reference.startswith('//'):
+        soup_uri = Soup.URI.new_with_base(Soup.URI.new(base), href)
+        return soup_uri.to_string(False)
+
+    base_path, base_query, base_fragment = _parse(_clean(base)[7:])
+    base_path = _remove_dot_segments(base_path)
+    path, query, fragment = _parse(reference)
+
+    if path is None:
+        path = base_path
+        if query is None:
+            query = base_query
+    else:
+        if not path.startswith('/'):
+            last = base_path.rfind('/')
+            path = base_path[:last + 1] + path
+        path = _remove_dot_segments(path)
+
+    return _to_string(path, query, fragment)
+
+
+@functools.lru_cache(maxsize=RESOLVE_CACHE_SIZE)
+def _split(uri):
+    cleaned = _clean(uri)
+
+    if not cleaned.startswith(EPUB_PREFIX):
+        soup_uri = Soup.URI.new(uri)
+        return soup_uri.get_path()[1:], soup_uri.get_fragment()
+
+    # Soup.URI.new() only removes dot segments when it has a base
+    path, query, fragment = _parse(cleaned[7:])
+
+    return path[1:], fragment
+
+
+def _clean(uri):
+    """
+    Drop the whitespace around a URI and the tabs and line breaks inside
+    it, which Soup.URI ignores
+    """
+    uri = uri.strip(WHITESPACE)
+    if '\t' in uri or '\n' in uri or '\r' in uri:
+        uri = uri.replace('\t', '').replace('\n', '').replace('\r', '')
+
+    return uri
+
+
+def _parse(reference):
+    """
+    Split a URI reference without scheme and host in its parts
+
+    :param reference: A URI reference
+    :return: A tuple with the normalized path, query and fragment, each
+        of them None when missing
+    """
+    reference, hash_mark, fragment = reference.partition('#')
+    reference, question_mark, query = reference.partition('?')
+
+    return (_normalize(reference) if reference else None,
+            _normalize(query) if question_mark else None,
+            _normalize(fragment) if hash_mark else None)
+
+
+def _normalize(part):
+    """
+    Decode the percent-encoded unreserved characters of a part of a URI,
+    and encode the characters that are not printable ASCII
+
+    :param part: A part of a URI
+    :return: The normalized part
+    """
+    if NORMALIZED.match(part):
+        return part
+
+    data = part.encode('utf-8', 'surrogateescape')
+    normalized = bytearray()
+    i = 0
+
+    while i < len(data):
+        c = data[i]
+        hex_digits = data[i + 1:i + 3]
+        if (c == 0x25 and len(hex_digits) == 2
+                and all(digit in HEX_DIGITS for digit in hex_digits)):
+            value = int(hex_digits, 16)
+            if value in UNRESERVED:
+                normalized.append(value)
+            else:
+                normalized += data[i:i + 3]
+            i += 3
+        elif 0x21 <= c <= 0x7e:
+            normalized.append(c)
+            i += 1
+        else:
+            normalized += b'%%%02X' % c
+            i += 1
+
+    return normalized.decode('ascii')
+
+
+def _remove_dot_segments(path):
+    """
+    Remove the '.' and '..' segments of a path, the way Soup.URI does,
+    which differs from RFC 3986 for '..' segments that can not be removed
+
+    :param path: A normalized path
+    :return: The path without dot segments
+    """
+    if '.' not in path:
+        return path
+
+    # Remove "./" where "." is a complete segment
+    i = 1
+    while i < len(path):
+        if path[i - 1] == '/' and path[i] == '.' and path[i + 1:i + 2] == '/':
+            path = path[:i] + path[i + 2:]
+        else:
+            i += 1
+
+    # Remove "." at the end
+    if len(path) > 2 and path.endswith('/.'):
+        path = path[:-1]
+
+    # Remove "<segment>/../" where <segment> is not ".."
+    i = 1
+    while i < len(path):
+        if path.startswith('../', i):
+            i += 3
+            continue
+
+        slash = path.find('/', i + 1)
+        if slash < 0:
+            break
+
+        if not path.startswith('/../', slash):
+            i = slash + 1
+            continue
+
+        path = path[:i] + path[slash + 4:]
+        i = 1
+
+    # Remove "<segment>/.." at the end where <segment> is not ".."
+    slash = path.rfind('/')
+    if slash > 0 and path[slash:] == '/..':
+        start = slash - 1
+        while start > 0 and path[start] != '/':
+            start -= 1
+        if not path.startswith('/../', start):
+            path = path[:start + 1]
+
+    # Remove the initial "/.." segments
+    while path.startswith('/../'):
+        path = path[3:]
+    if path == '/..':
+        path = '/'
+
+    return path
+
+
+def _to_string(path, query, fragment):
+    uri = 'epub://' + path
+
+    if query is not None:
+        uri += '?' + query
+    if fragment is not None:
+        uri += '#' + fragment
+
+    return uri
@@ -62,6 +62,8 @@ class ApplicationWindow(Gtk.ApplicationWindow):
     search_prev_btn = GtkTemplate.Child()
     search_next_btn = GtkTemplate.Child()
     open_btn = GtkTemplate.Child()
+    open_spinner = GtkTemplate.Child()
+    open_cancel_btn = GtkTemplate.Child()
     overlay_controls = GtkTemplate.Child()
     bottom_revealer = GtkTemplate.Child()
     prev_btn_revealer = GtkTemplate.Child()
@@ -80,6 +82,7 @@ class ApplicationWindow(Gtk.ApplicationWindow):
         self.book = Book(self.settings)
         self.gtk_settings = Gtk.Settings.get_default()
         self.overlay_timeout_source = None
+        self.open_cancellable = None
 
         color_variant = GLib.Variant.new_string(self.settings.color)
         color_action = Gio.SimpleAction.new_stateful('color',
@@ -136,6 +139,8 @@ class ApplicationWindow(Gtk.ApplicationWindow):
         self.book.connect('key-press-event', self.on_book_key_press_event)
         self.book.connect('scroll-percent-changed',
                           self.on_scroll_percent_changed)
+        self.book.connect('note-activated', self.on_note_activated)
+        self.book.get_doc().connect('open-progress', self.on_open_progress)
 
         self.book_view.connect('motion-notify-event',
                                self.on_motion_notify_event)
@@ -146,10 +151,46 @@ class ApplicationWindow(Gtk.ApplicationWindow):
         self.connect('size-allocate', self.on_size_allocate)
 
     def open_file(self, _gfile):
+        """
+        Start opening a book, replacing any book that is still being opened
+
+        :param _gfile: A Gio.File object
+        """
+        if self.open_cancellable:
+            self.open_cancellable.cancel()
+
+        cancellable = Gio.Cancellable()
+
         try:
-            self.book.set_doc(_gfile)
+            self.book.set_doc_async(_gfile,
+                                    cancellable,
+                                    self.on_book_opened,
+                                    cancellable)
         except BookError as e:
             self.show_infobar(e)
+        else:
+            self.open_cancellable = cancellable
+            self.show_open_progress(True)
+
+    def on_book_opened(self, book, result, cancellable):
+        """
+        Callback function when a book finished opening in the background
+
+        :param book: The Book object
+        :param result: The result to give to Book.set_doc_finish()
+        :param cancellable: The Gio.Cancellable object of this operation
+        """
+        if cancellable is self.open_cancellable:
+            self.open_cancellable = None
+            self.show_open_progress(False)
+
+        try:
+            book.set_doc_finish(result)
+        except BookError as e:
+            self.show_infobar(e)
+        except GLib.Error as e:
+            if not e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                raise
         else:
             self.header_bar.set_title(self.book.get_title())
             self.header_bar.set_subtitle(self.book.get_author())
@@ -161,6 +202,88 @@ class ApplicationWindow(Gtk.ApplicationWindow):
             self.search_btn.set_sensitive(True)
             self.open_menu.set_sensitive(True)
 
+    def show_open_progress(self, opening):
+        """
+        Show or hide the spinner and cancel button used while opening
+
+        :param opening: True while a book is being opened
+        """
+        if opening:
+            self.open_spinner.start()
+            self.header_bar.set_subtitle(_('Opening…'))
+        else:
+            self.open_spinner.stop()
+            self.header_bar.set_subtitle(self.book.get_author())
+
+        self.open_spinner.set_visible(opening)
+        self.open_cancel_btn.set_visible(opening)
+
+    def on_open_progress(self, epub, fraction):
+        if self.open_cancellable:
+            self.header_bar.set_subtitle(
+                _('Opening…') + ' {0:.0%}'.format(fraction))
+
+    @GtkTemplate.Callback
+    def on_open_cancel_btn(self, widget):
+        if self.open_cancellable:
+            self.open_cancellable.cancel()
+
+    def on_note_activated(self, book, note):
+        """
+        Show the text of a note in a popover, next to the pointer
+
+        :param book: The Book which emitted the signal
+        :param note: The text of the note
+        """
+        seat = Gdk.Display.get_default().get_default_seat()
+        window, x, y, mask = book.get_window().get_device_position(
+            seat.get_pointer())
+
+        rectangle = Gdk.Rectangle()
+        rectangle.x, rectangle.y = x, y
+        rectangle.width = rectangle.height = 1
+
+        label = Gtk.Label(label=note,
+                          wrap=True,
+                          selectable=True,
+                          max_width_chars=60,
+                          margin=12)
+        label.show()
+
+        popover = Gtk.Popover(relative_to=book, pointing_to=rectangle)
+        popover.add(label)
+        popover.connect('closed', lambda popover: popover.destroy())
+        popover.popup()
+
+    def show_page_label_popover(self):
+        """
+        Ask for a printed page in a popover under the table of contents
+        button, when the book has a page list
+        """
+        if not self.toc_btn.get_sensitive() or not self.book.doc.page_list:
+            return
+
+        entry = Gtk.Entry(placeholder_text=_('Printed page'), margin=6)
+        entry.show()
+
+        popover = Gtk.Popover(relative_to=self.toc_btn)
+        popover.add(entry)
+        popover.connect('closed', lambda popover: popover.destroy())
+        entry.connect('activate', self.on_page_label_activate, popover)
+        entry.connect('changed', self.on_page_label_changed)
+        popover.popup()
+        entry.grab_focus()
+
+    def on_page_label_activate(self, entry, popover):
+        if self.book.set_page_label(entry.get_text()):
+            popover.popdown()
+            self.book.grab_focus()
+        else:
+            entry.get_style_context().add_class(Gtk.STYLE_CLASS_ERROR)
+
+    def on_page_label_changed(self, entry):
+        entry.get_style_context().remove_class(Gtk.STYLE_CLASS_ERROR)
+
     def show_infobar(self, error):
         error_code = error.args[0]
         error_message = error.args[1]
@@ -399,6 +522,12 @@ class ApplicationWindow(Gtk.ApplicationWindow):
             self.search_entry.grab_focus()
             return True
 
+        if (event.state
+                and event.state == Gdk.ModifierType.CONTROL_MASK
+                and event.keyval == Gdk.KEY_l):
+            self.show_page_label_popover()
+            return True
+
         if (event.state
                 and event.state == Gdk.ModifierType.CONTROL_MASK
                 and event.keyval == Gdk.KEY_g):
@@ -0,0 +1,83 @@
+# test_container.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import unittest
+import unittest.mock
+import zipfile
+
+from seneca.container import ZipContainer
+
+MEMBERS = {'a.txt': b'first member ' * 100,
+           'b.txt': b'second member ' * 100,
+           'c.txt': b'third member ' * 100}
+
+
+def write_zip(path, members, compress_type):
+    with zipfile.ZipFile(path, 'w', compress_type) as zip_file:
+        for name, content in members.items():
+            zip_file.writestr(name, content)
+
+
+class TestZipContainer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'book.epub')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def replace_file(self, compress_type):
+        # Other members at other offsets, written to the same path
+        new_path = self.path + '.new'
+        write_zip(new_path, {'z' + name: content[::-1]
+                             for name, content in MEMBERS.items()},
+                  compress_type)
+        os.replace(new_path, self.path)
+
+    # Read in batches even on a single processor
+    @unittest.mock.patch('seneca.container.BULK_READ_WORKERS', 2)
+    def test_read_many_after_replace(self):
+        for compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            with self.subTest(compress_type=compress_type):
+                write_zip(self.path, MEMBERS, compress_type)
+                container = ZipContainer(self.path)
+                try:
+                    self.replace_file(compress_type)
+                    container.release_mapping()
+                    self.assertEqual(container.read_many(MEMBERS), MEMBERS)
+                finally:
+                    container.close()
+
+    def test_get_bytes_after_replace(self):
+        write_zip(self.path, MEMBERS, zipfile.ZIP_STORED)
+        container = ZipContainer(self.path)
+        try:
+            self.replace_file(zipfile.ZIP_STORED)
+            self.assertEqual(container.get_bytes('b.txt').get_data(),
+                             MEMBERS['b.txt'])
+            container.release_mapping()
+            self.assertEqual(container.get_bytes('c.txt').get_data(),
+                             MEMBERS['c.txt'])
+        finally:
+            container.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# test_epub.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import unittest
+import zipfile
+
+from seneca.epub import Epub
+
+CONTAINER = b'''<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>'''
+
+OPF = b'''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="id">test</dc:identifier>
+    <dc:title>Test</dc:title>
+    <dc:language>en</dc:language>
+  </metadata>
+  <manifest>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+    <item id="chapter" href="chapter.xhtml" media-type="application/xhtml+xml"/>
+  </manifest>
+  <spine>
+    <itemref idref="chapter"/>
+  </spine>
+</package>'''
+
+NAV = b'''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<body><nav epub:type="toc"><ol><li><a href="chapter.xhtml">One</a></li></ol></nav></body>
+</html>'''
+
+# A body with more than one child and no head, which lxml.html.fromstring
+# returns as a div when the document starts with an XML declaration
+CHAPTER = b'''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><body><p>First paragraph</p>
+<p>Second   paragraph</p></body></html>'''
+
+
+MEMBERS = [('mimetype', b'application/epub+zip'),
+           ('META-INF/container.xml', CONTAINER),
+           ('OEBPS/content.opf', OPF),
+           ('OEBPS/nav.xhtml', NAV),
+           ('OEBPS/chapter.xhtml', CHAPTER)]
+
+
+def open_epub(path):
+    """
+    Open a book without reading or writing the user caches
+    """
+    epub = Epub()
+    epub.index_cache = None
+    epub.dependency_cache = None
+    epub.notes_cache = None
+    epub.open(path)
+
+    return epub
+
+
+class TestText(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp_dir.name, 'book.epub')
+
+        with zipfile.ZipFile(path, 'w') as epub_zip:
+            for name, content in MEMBERS:
+                epub_zip.writestr(name, content)
+
+        self.epub = open_epub(path)
+
+    def tearDown(self):
+        self.epub.close()
+        self.tmp_dir.cleanup()
+
+    def test_get_text_with_xml_declaration(self):
+        self.assertEqual(self.epub.get_text('OEBPS/chapter.xhtml'),
+                         'First paragraph\nSecond paragraph')
+
+    def test_iter_text_with_xml_declaration(self):
+        self.assertEqual(list(self.epub.iter_text()),
+                         [('OEBPS/chapter.xhtml',
+                           'First paragraph\nSecond paragraph')])
+
+    def test_find_text_with_xml_declaration(self):
+        self.assertEqual(self.epub.find_text('SECOND'),
+                         [['OEBPS/chapter.xhtml', True]])
+
+
+
+class TestOpen(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'book.epub')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_open_with_empty_nav(self):
+        with zipfile.ZipFile(self.path, 'w') as epub_zip:
+            for name, content in MEMBERS:
+                if name == 'OEBPS/nav.xhtml':
+                    content = b''
+                epub_zip.writestr(name, content)
+
+        epub = open_epub(self.path)
+        try:
+            self.assertEqual(list(epub.spine_primary),
+                             ['OEBPS/chapter.xhtml'])
+            self.assertEqual(len(epub.page_list), 0)
+        finally:
+            epub.close()
+
+
+class TestReload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'book')
+
+        for name, content in MEMBERS:
+            member_path = os.path.join(self.path, *name.split('/'))
+            os.makedirs(os.path.dirname(member_path), exist_ok=True)
+            with open(member_path, 'wb') as member:
+                member.write(content)
+
+        self.epub = open_epub(self.path)
+
+    def tearDown(self):
+        self.epub.close()
+        self.tmp_dir.cleanup()
+
+    def test_reload_directory_after_edit(self):
+        chapter_path = os.path.join(self.path, 'OEBPS', 'chapter.xhtml')
+        self.epub.get_resource_content('OEBPS/chapter.xhtml')
+
+        with open(chapter_path, 'wb') as chapter:
+            chapter.write(CHAPTER.replace(b'Second', b'Edited second'))
+
+        self.assertEqual(self.epub.reload(), {'OEBPS/chapter.xhtml'})
+        self.assertIn(b'Edited second',
+                      self.epub.get_resource_content('OEBPS/chapter.xhtml'))
+
+
+if __name__ == '__main__':
+    unittest.main()
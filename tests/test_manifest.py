@@ -0,0 +1,38 @@
+# test_manifest.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from seneca.manifest import get_label_key
+
+
+class TestLabelKey(unittest.TestCase):
+
+    def test_arabic_before_roman_before_other(self):
+        labels = ['B', '10', 'xiv', '2', 'iv', 'A']
+        self.assertEqual(sorted(labels, key=get_label_key),
+                         ['2', '10', 'iv', 'xiv', 'A', 'B'])
+
+    def test_digits_that_are_not_decimal(self):
+        self.assertEqual(get_label_key('²'), (2, 0, '²'))
+
+    def test_decimal_digits_of_other_scripts(self):
+        self.assertEqual(get_label_key('٣'), (0, 3, ''))
+
+
+if __name__ == '__main__':
+    unittest.main()
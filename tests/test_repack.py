@@ -0,0 +1,138 @@
+# test_repack.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import unittest
+import zipfile
+
+from seneca.epub import Epub
+from seneca.repack import repack
+
+CONTAINER = b'''<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>'''
+
+OPF = b'''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="id">test</dc:identifier>
+    <dc:title>Test</dc:title>
+    <dc:language>en</dc:language>
+  </metadata>
+  <manifest>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+    <item id="chapter" href="chapter.xhtml" media-type="application/xhtml+xml" properties="svg"/>
+    <item id="bg" href="bg.png" media-type="image/png"/>
+    <item id="a" href="a.png" media-type="image/png"/>
+    <item id="a2" href="a-2x.png" media-type="image/png"/>
+    <item id="a3" href="a-3x.png" media-type="image/png"/>
+    <item id="b" href="b.png" media-type="image/png"/>
+    <item id="c" href="c.png" media-type="image/png"/>
+    <item id="icons" href="icons.svg" media-type="image/svg+xml"/>
+    <item id="script" href="gallery.js" media-type="application/javascript"/>
+    <item id="lazy" href="lazy.png" media-type="image/png"/>
+    <item id="unused" href="unused.png" media-type="image/png"/>
+  </manifest>
+  <spine>
+    <itemref idref="chapter"/>
+  </spine>
+</package>'''
+
+NAV = b'''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<body><nav epub:type="toc"><ol><li><a href="chapter.xhtml">One</a></li></ol></nav></body>
+</html>'''
+
+CHAPTER = b'''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><script src="gallery.js"/></head>
+<body style="background-image: url('bg.png')">
+<img src="a.png" srcset="a-2x.png 2x,a-3x.png 3x"/>
+<picture><source srcset="b.png"/></picture>
+<svg xmlns="http://www.w3.org/2000/svg">
+<image href="c.png"/><use href="icons.svg#icon"/>
+</svg>
+</body></html>'''
+
+# An image only a script refers to
+SCRIPT = b'''document.images[0].src = "lazy.png";'''
+
+MEMBERS = [('mimetype', b'application/epub+zip'),
+           ('META-INF/container.xml', CONTAINER),
+           ('OEBPS/content.opf', OPF),
+           ('OEBPS/nav.xhtml', NAV),
+           ('OEBPS/chapter.xhtml', CHAPTER),
+           ('OEBPS/icons.svg', b'<svg xmlns="http://www.w3.org/2000/svg"/>'),
+           ('OEBPS/gallery.js', SCRIPT)]
+IMAGES = ['bg.png', 'a.png', 'a-2x.png', 'a-3x.png', 'b.png', 'c.png',
+          'lazy.png', 'unused.png']
+
+
+class TestRepack(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'book.epub')
+        self.output_path = os.path.join(self.tmp_dir.name, 'output.epub')
+
+        with zipfile.ZipFile(self.path, 'w') as epub_zip:
+            for name, content in MEMBERS:
+                epub_zip.writestr(name, content)
+            for name in IMAGES:
+                epub_zip.writestr('OEBPS/' + name, b'\x89PNG\r\n\x1a\n')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_dependencies_in_attributes(self):
+        epub = Epub()
+        epub.index_cache = None
+        epub.dependency_cache = None
+        epub.notes_cache = None
+        epub.open(self.path)
+
+        try:
+            dependencies = epub.get_dependencies('OEBPS/chapter.xhtml')
+        finally:
+            epub.close()
+
+        self.assertEqual(set(dependencies),
+                         {'OEBPS/' + name
+                          for name in ('gallery.js', 'bg.png', 'a.png',
+                                       'a-2x.png', 'a-3x.png', 'b.png',
+                                       'c.png', 'icons.svg')})
+
+    def test_repack_keeps_used_images(self):
+        report = repack(self.path, self.output_path)
+
+        with zipfile.ZipFile(self.output_path) as output_zip:
+            names = set(output_zip.namelist())
+            opf = output_zip.read('OEBPS/content.opf')
+
+        for name in IMAGES[:-1]:
+            self.assertIn('OEBPS/' + name, names)
+            self.assertIn(name.encode('ascii'), opf)
+
+        self.assertEqual(report.dropped, ['OEBPS/unused.png'])
+        self.assertNotIn(b'unused.png', opf)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+# test_uri.py
+#
+# Copyright (C) 2017 Eddy Castillo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import posixpath
+import unittest
+
+try:
+    import gi
+    gi.require_version('Soup', '2.4')
+    from gi.repository import Soup
+except (ImportError, ValueError):
+    Soup = None
+
+from seneca.uri import (decode_uri, get_epub_uri, resolve_href,
+                        resolve_href_path, split_uri)
+
+# Document path, reference and the URI Soup.URI.new_with_base() gives for
+# them, following soup-uri.c of libsoup 2.4. TestSoupConformance checks
+# them against Soup itself.
+RESOLVED = [
+    # Relative paths
+    ('OEBPS/Text/ch1.xhtml', 'ch2.xhtml', 'epub:///OEBPS/Text/ch2.xhtml'),
+    ('OEBPS/Text/ch1.xhtml', '../Styles/style.css',
+     'epub:///OEBPS/Styles/style.css'),
+    ('OEBPS/Text/ch1.xhtml', '/OEBPS/cover.xhtml',
+     'epub:///OEBPS/cover.xhtml'),
+    ('ch1.xhtml', 'images/cover.jpg', 'epub:///images/cover.jpg'),
+    ('OEBPS/ch1.xhtml', '', 'epub:///OEBPS/'),
+    ('OEBPS/ch1.xhtml', '  ch2.xhtml\n', 'epub:///OEBPS/ch2.xhtml'),
+    ('OEBPS/ch1.xhtml', 'ch\t2.xh\ntml', 'epub:///OEBPS/ch2.xhtml'),
+    # Dot segments
+    ('OEBPS/Text/ch1.xhtml', './images/../img.png',
+     'epub:///OEBPS/Text/img.png'),
+    ('OEBPS/Text/ch1.xhtml', '../../../up.css', 'epub:///up.css'),
+    ('ch1.xhtml', '../../up.css', 'epub:///up.css'),
+    ('a/b/c.xhtml', '..', 'epub:///a/'),
+    ('a/b/c.xhtml', '.', 'epub:///a/b/'),
+    ('a/b/c.xhtml', '../..', 'epub:///'),
+    ('a/b/c.xhtml', 'x/../../y/./z.css', 'epub:///a/y/z.css'),
+    ('OEBPS/Text/ch1.xhtml', '%2e%2e/x.css', 'epub:///OEBPS/x.css'),
+    # Fragments and queries
+    ('OEBPS/ch1.xhtml', '#note1', 'epub:///OEBPS/ch1.xhtml#note1'),
+    ('OEBPS/ch1.xhtml', '#', 'epub:///OEBPS/ch1.xhtml#'),
+    ('OEBPS/ch1.xhtml', 'ch2.xhtml#note1', 'epub:///OEBPS/ch2.xhtml#note1'),
+    ('OEBPS/ch1.xhtml', 'ch2.xhtml?x=1#f', 'epub:///OEBPS/ch2.xhtml?x=1#f'),
+    ('OEBPS/ch1.xhtml', '?q', 'epub:///OEBPS/?q'),
+    # Non-ASCII
+    ('OEBPS/ch1.xhtml', 'capítulo 2.xhtml',
+     'epub:///OEBPS/cap%C3%ADtulo%202.xhtml'),
+    ('OEBPS/ch1.xhtml', '#nota-ñ', 'epub:///OEBPS/ch1.xhtml#nota-%C3%B1'),
+    ('OEBPS/tëxt/ch1.xhtml', 'a.css', 'epub:///OEBPS/t%C3%ABxt/a.css'),
+    ('OEBPS/ch1.xhtml', '日本.xhtml',
+     'epub:///OEBPS/%E6%97%A5%E6%9C%AC.xhtml'),
+    # Percent-encoding, only unreserved characters are decoded
+    ('OEBPS/ch1.xhtml', 'a%20b.xhtml', 'epub:///OEBPS/a%20b.xhtml'),
+    ('OEBPS/ch1.xhtml', '%7Efile.xhtml', 'epub:///OEBPS/~file.xhtml'),
+    ('OEBPS/ch1.xhtml', '%41b.xhtml', 'epub:///OEBPS/Ab.xhtml'),
+    ('OEBPS/ch1.xhtml', 'a%2Fb.xhtml', 'epub:///OEBPS/a%2Fb.xhtml'),
+    ('OEBPS/ch1.xhtml', '%c3%a9.xhtml', 'epub:///OEBPS/%c3%a9.xhtml'),
+    ('OEBPS/ch1.xhtml', '100%.xhtml', 'epub:///OEBPS/100%.xhtml'),
+    ('OEBPS/ch1.xhtml', 'a%zzb.xhtml', 'epub:///OEBPS/a%zzb.xhtml'),
+    ('OEBPS/ch1.xhtml', 'ch2.xhtml#a%20b', 'epub:///OEBPS/ch2.xhtml#a%20b'),
+]
+
+# URI and the path and fragment Soup.URI gives for it
+SPLIT = [
+    ('epub:///OEBPS/a%20b.xhtml#f', ('OEBPS/a%20b.xhtml', 'f')),
+    ('epub:///OEBPS/x/../a.xhtml', ('OEBPS/x/../a.xhtml', None)),
+    ('epub:///a.xhtml?q#', ('a.xhtml', '')),
+    ('epub:///a.xhtml?q', ('a.xhtml', None)),
+]
+
+
+class TestResolveHref(unittest.TestCase):
+
+    def test_resolve_href(self):
+        for document_path, href, uri in RESOLVED:
+            with self.subTest(document_path=document_path, href=href):
+                self.assertEqual(resolve_href(document_path, href), uri)
+
+    def test_resolve_href_path(self):
+        self.assertEqual(resolve_href_path('OEBPS/Text/ch1.xhtml',
+                                           '../Images/a%20b.png#x'),
+                         'OEBPS/Images/a b.png')
+        self.assertEqual(resolve_href_path('OEBPS/ch1.xhtml', '#note1'),
+                         'OEBPS/ch1.xhtml')
+        self.assertIsNone(resolve_href_path('OEBPS/ch1.xhtml',
+                                            'https://example.com/a'))
+        self.assertIsNone(resolve_href_path('OEBPS/ch1.xhtml',
+                                            '//example.com/a'))
+
+
+class TestSplitUri(unittest.TestCase):
+
+    def test_split_uri(self):
+        for uri, parts in SPLIT:
+            with self.subTest(uri=uri):
+                self.assertEqual(split_uri(uri), parts)
+
+    def test_epub_uri_round_trip(self):
+        path = 'OEBPS/cap í#1?.xhtml'
+        uri = get_epub_uri(path)
+
+        self.assertEqual(uri, 'epub:///OEBPS/cap%20%C3%AD%231%3F.xhtml')
+        self.assertEqual(decode_uri(split_uri(uri)[0]), path)
+
+
+
+@unittest.skipUnless(Soup is not None, 'libsoup 2.4 is not available')
+class TestSoupConformance(unittest.TestCase):
+    """
+    Compare the resolver with Soup.URI, which resolved the URIs of the
+    book before
+    """
+
+    def test_resolve_href_like_soup(self):
+        for document_path, href, uri in RESOLVED:
+            with self.subTest(document_path=document_path, href=href):
+                if href.startswith('#'):
+                    base = 'epub:///' + document_path
+                else:
+                    dirname = posixpath.dirname(document_path)
+                    base = 'epub:///' + dirname + '/' if dirname else (
+                        'epub:///')
+
+                soup_uri = Soup.URI.new_with_base(Soup.URI.new(base), href)
+                self.assertEqual(soup_uri.to_string(False), uri)
+                self.assertEqual(resolve_href(document_path, href), uri)
+
+    def test_split_uri_like_soup(self):
+        for uri, parts in SPLIT:
+            with self.subTest(uri=uri):
+                soup_uri = Soup.URI.new(uri)
+                soup_parts = (soup_uri.get_path()[1:],
+                              soup_uri.get_fragment())
+                self.assertEqual(soup_parts, parts)
+                self.assertEqual(split_uri(uri), parts)
+
+
+if __name__ == '__main__':
+    unittest.main()